@@ -0,0 +1,127 @@
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+from kivy.clock import Clock
+from kivy.graphics.texture import Texture
+from kivy.logger import Logger
+from kivy.metrics import dp
+from utils import avatar_variant
+
+class AvatarCache:
+    """Общий кэш текстур аватаров.
+
+    Аватар декодируется и уменьшается до размера в списке сообщений один
+    раз, после чего все строки с этим аватаром используют одну и ту же
+    текстуру. Ключ - (user_id, версия аватара), версией служит путь к файлу.
+    При превышении лимита памяти вытесняются давно не использованные текстуры.
+    Аватары, которых нет на устройстве, скачиваются через media_cache.
+    """
+    def __init__(self, default_path, size=dp(40), max_bytes=8 * 1024 * 1024, media_cache=None):
+        self.default_path = default_path
+        self.media_cache = media_cache
+        self.size = int(size)
+        self.max_bytes = max_bytes
+        self._textures = OrderedDict()  # (user_id, версия): текстура
+        self._bytes = 0
+        self._exists = {}  # путь: есть ли файл, проверяется один раз
+        self._pending = {}  # ключ: колбэки, ждущие загрузки
+        self._failed = set()  # ключи, которые не удалось загрузить
+        self._default_texture = None
+
+    def get(self, user_id, path, callback=None):
+        """Текстура аватара.
+
+        Если текстура еще не загружена, сразу возвращается аватар по
+        умолчанию, а загрузка идет в фоне; по ее окончании вызывается
+        callback(key, texture) в главном потоке.
+        """
+        # В списке сообщений показываем только маленький вариант аватара
+        path = avatar_variant(path, 'small')
+        if not path or (self.media_cache is None and not self._file_exists(path)):
+            return self.default_texture()
+        
+        key = (user_id, path)
+        if key in self._failed:
+            return self.default_texture()
+        texture = self._textures.get(key)
+        if texture is not None:
+            self._textures.move_to_end(key)
+            return texture
+        
+        callbacks = self._pending.get(key)
+        if callbacks is None:
+            callbacks = self._pending[key] = []
+            threading.Thread(target=self._decode, args=(key, path), daemon=True).start()
+        if callback is not None:
+            callbacks.append(callback)
+        return self.default_texture()
+
+    def default_texture(self):
+        if self._default_texture is None:
+            self._default_texture = self._make_texture(self._load_pixels(self.default_path))
+        return self._default_texture
+
+    def invalidate(self, user_id):
+        """Сбрасывает текстуры пользователя, например после смены аватара"""
+        for key in [key for key in self._textures if key[0] == user_id]:
+            self._forget(key)
+        for key in [key for key in self._pending if key[0] == user_id]:
+            del self._pending[key]
+        self._failed = {key for key in self._failed if key[0] != user_id}
+        self._exists.clear()
+
+    def _file_exists(self, path):
+        exists = self._exists.get(path)
+        if exists is None:
+            exists = self._exists[path] = os.path.exists(path)
+        return exists
+
+    def _load_pixels(self, path):
+        # Обрезаем до квадрата по центру и уменьшаем до размера аватара
+        with Image.open(path) as image:
+            image = ImageOps.fit(image.convert('RGBA'), (self.size, self.size))
+        return image.size, image.tobytes()
+
+    def _decode(self, key, path):
+        # Декодирование идет в фоне, текстура создается в главном потоке
+        try:
+            if not self._file_exists(path):
+                # Локального файла нет - берем с сервера (или из дискового кэша)
+                path = self.media_cache.fetch(path)
+            pixels = self._load_pixels(path) if path else None
+        except Exception as e:
+            Logger.warning(f"AvatarCache: не удалось загрузить {path}: {e}")
+            pixels = None
+        Clock.schedule_once(lambda dt: self._finish(key, pixels))
+
+    def _finish(self, key, pixels):
+        callbacks = self._pending.pop(key, None)
+        if callbacks is None:
+            # Аватар сбросили, пока он загружался
+            return
+        if pixels is None:
+            self._failed.add(key)
+            texture = self.default_texture()
+        else:
+            texture = self._make_texture(pixels)
+            self._textures[key] = texture
+            self._bytes += len(pixels[1])
+            self._evict()
+        for callback in callbacks:
+            callback(key, texture)
+
+    def _make_texture(self, pixels):
+        size, data = pixels
+        texture = Texture.create(size=size, colorfmt='rgba')
+        texture.blit_buffer(data, colorfmt='rgba', bufferfmt='ubyte')
+        texture.flip_vertical()
+        return texture
+
+    def _forget(self, key):
+        texture = self._textures.pop(key)
+        self._bytes -= texture.width * texture.height * 4
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._textures) > 1:
+            self._forget(next(iter(self._textures)))
\ No newline at end of file
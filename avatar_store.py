@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from database import Database
+from utils import AVATAR_FILE_NAME, process_avatar
+
+class AvatarStore:
+    """Хранилище аватаров с адресацией по содержимому.
+
+    Файлы называются по хэшу изображения, поэтому одинаковые картинки
+    хранятся один раз, а смена аватара всегда дает новый путь и сама
+    сбрасывает кэши. Число пользователей, ссылающихся на каждый хэш,
+    хранится в таблице avatar_blobs, неиспользуемые файлы удаляет
+    фоновая сборка мусора.
+    """
+    def __init__(self, db, directory='avatars', scale=1.0, grace_period=3600):
+        self.db = db
+        self.directory = directory
+        self.scale = scale
+        self.grace_period = grace_period  # сколько секунд хранить файлы без ссылок
+        self._gc_thread = None
+
+    def add(self, source_path):
+        """Кладет изображение в хранилище, возвращает (хэш, пути вариантов).
+
+        Перекодирует изображение, поэтому вызывать вне UI-потока.
+        """
+        return process_avatar(source_path, scale=self.scale, directory=self.directory)
+
+    def assign(self, user_id, avatar_hash, paths):
+        """Назначает пользователю аватар из хранилища"""
+        return self.db.update_avatar(user_id, avatar_hash, paths['large'])
+
+    def start_gc(self):
+        """Запускает сборку мусора в фоновом потоке, если она еще не идет"""
+        if self._gc_thread is not None and self._gc_thread.is_alive():
+            return
+        self._gc_thread = threading.Thread(target=self.collect_garbage, name='avatar-gc', daemon=True)
+        self._gc_thread.start()
+
+    def collect_garbage(self):
+        """Удаляет файлы аватаров, на которые больше никто не ссылается"""
+        if not os.path.exists(self.directory):
+            return
+        # Файлы моложе cutoff не удаляем: process_avatar обновляет время
+        # изменения файлов, которые использует повторно, и их вот-вот назначат
+        cutoff = time.time() - self.grace_period
+        files = {}
+        for file_name in os.listdir(self.directory):
+            match = AVATAR_FILE_NAME.match(file_name)
+            # Старые аватары вида user_<id>.png не трогаем
+            if match:
+                files.setdefault(match.group(1), []).append(os.path.join(self.directory, file_name))
+        
+        # У фонового потока свое подключение, чтобы не мешать основному
+        db = Database(self.db.config, init_schema=False)
+        try:
+            released = set(db.release_unused_avatars(
+                self.grace_period, lambda avatar_hash: self._remove(files.get(avatar_hash, ()), cutoff)
+            ))
+            known = db.get_avatar_hashes()
+        finally:
+            db.close()
+        
+        # Файлы без записи в базе - брошенные загрузки
+        for avatar_hash, paths in files.items():
+            if avatar_hash not in known and avatar_hash not in released:
+                self._remove(paths, cutoff)
+
+    def _remove(self, paths, cutoff):
+        """Удаляет файлы вариантов одного аватара, если ни один не изменялся после cutoff"""
+        try:
+            if any(os.path.getmtime(path) >= cutoff for path in paths if os.path.exists(path)):
+                return False
+        except OSError:
+            return False
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Error removing avatar {path}: {e}")
+        return True
\ No newline at end of file
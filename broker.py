@@ -0,0 +1,193 @@
+import asyncio
+import os
+import struct
+import time
+
+# Максимальный размер одного сообщения шины
+MAX_MESSAGE = 256 * 1024
+# Заголовок кадра шины: длина сообщения в байтах
+HEADER = struct.Struct('>I')
+# Сколько кадров может ждать отправки одному процессу
+PEER_QUEUE_SIZE = 1024
+# Сколько секунд публикация ждет места в очереди процесса, прежде чем считать его остановившимся
+PEER_PUT_TIMEOUT = 1.0
+
+class Broker:
+    """Шина рассылки сообщений между процессами сервера.
+
+    Каждый процесс держит свою часть WebSocket-подключений. broadcast
+    публикует сообщение в шину, а шина вызывает deliver(payload) в
+    каждом процессе, включая отправителя.
+    """
+    async def start(self, deliver):
+        raise NotImplementedError
+
+    async def publish(self, payload: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class MemoryBroker(Broker):
+    """Шина внутри одного процесса"""
+    def __init__(self):
+        self._deliver = None
+
+    async def start(self, deliver):
+        self._deliver = deliver
+
+    async def publish(self, payload: str):
+        self._deliver(payload)
+
+class _Peer:
+    """Очередь кадров другому процессу и задача, которая их отправляет"""
+    __slots__ = ('queue', 'task', 'dropped')
+
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.task = None
+        self.dropped = 0
+
+class UnixSocketBroker(Broker):
+    """Шина между процессами на одной машине.
+
+    Каждый процесс слушает свой потоковый Unix-сокет в общем каталоге.
+    Сообщения передаются кадрами с длиной в заголовке. Каждому процессу
+    кадры отправляет своя задача из своей очереди: она одна открывает
+    подключение к нему и ждет, пока он разберет данные (drain). Когда
+    очередь полна, публикация ждет места не дольше put_timeout; процесс,
+    который за это время не освободил ее, считается остановившимся, и
+    кадры для него отбрасываются без ожидания, пока очередь не опустеет.
+    Так остановившийся процесс не задерживает публикацию остальным.
+    Внешние сервисы не нужны. Сокеты завершившихся процессов удаляются
+    при первой неудачной отправке.
+    """
+    def __init__(self, directory='/tmp/chat-bus', name=None, peers_ttl=1.0, queue_size=PEER_QUEUE_SIZE,
+                 put_timeout=PEER_PUT_TIMEOUT):
+        self.directory = directory
+        self.name = name or f'{os.getpid()}.sock'
+        self.peers_ttl = peers_ttl  # как часто перечитывать список процессов, секунд
+        self.queue_size = queue_size
+        self.put_timeout = put_timeout
+        self.path = os.path.join(directory, self.name)
+        self._deliver = None
+        self._server = None
+        self._incoming = set()  # входящие подключения других процессов
+        self._senders = {}  # путь сокета процесса: _Peer
+        self._peers = []
+        self._peers_time = 0
+
+    async def start(self, deliver):
+        self._deliver = deliver
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._on_connection, path=self.path)
+
+    async def _on_connection(self, reader, writer):
+        self._incoming.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                (length,) = HEADER.unpack(header)
+                if length > MAX_MESSAGE:
+                    print(f"Broker: сообщение длиной {length} больше допустимого, подключение закрыто")
+                    return
+                self._deliver((await reader.readexactly(length)).decode('utf-8'))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Процесс-отправитель завершился или шина закрывается
+            pass
+        finally:
+            self._incoming.discard(writer)
+            writer.close()
+
+    def _peer_paths(self):
+        now = time.monotonic()
+        if now - self._peers_time > self.peers_ttl:
+            self._peers = [
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.sock') and name != self.name
+            ]
+            self._peers_time = now
+        return self._peers
+
+    async def publish(self, payload: str):
+        data = payload.encode('utf-8')
+        if len(data) > MAX_MESSAGE:
+            raise ValueError(f"Сообщение шины длиной {len(data)} больше {MAX_MESSAGE} байт")
+        # Своим подключениям доставляем напрямую, остальным - через очереди процессов
+        self._deliver(payload)
+        frame = HEADER.pack(len(data)) + data
+        for path in self._peer_paths():
+            peer = self._senders.get(path)
+            if peer is None:
+                peer = self._senders[path] = _Peer(self.queue_size)
+                peer.task = asyncio.create_task(self._send_loop(path, peer))
+            try:
+                peer.queue.put_nowait(frame)
+                continue
+            except asyncio.QueueFull:
+                pass
+            if not peer.dropped:
+                try:
+                    await asyncio.wait_for(peer.queue.put(frame), self.put_timeout)
+                    continue
+                except asyncio.TimeoutError:
+                    print(f"Broker: процесс {path} не читает шину, сообщения для него отбрасываются")
+            peer.dropped += 1
+
+    async def _send_loop(self, path, peer):
+        # Единственное место, где открывается подключение к процессу, поэтому
+        # одновременные публикации не создают лишних подключений
+        writer = None
+        try:
+            while True:
+                frame = await peer.queue.get()
+                if writer is None:
+                    _, writer = await asyncio.open_unix_connection(path)
+                # Кадр пишется одним вызовом, поэтому кадры разных публикаций не перемешиваются
+                writer.write(frame)
+                await writer.drain()
+                if peer.queue.empty():
+                    peer.dropped = 0
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Процесс завершился и не убрал за собой сокет
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        except ConnectionError:
+            # Процесс завершился после подключения
+            pass
+        finally:
+            if writer is not None:
+                writer.close()
+            if self._senders.get(path) is peer:
+                del self._senders[path]
+            self._peers_time = 0
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            tasks = [peer.task for peer in self._senders.values()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for writer in list(self._incoming):
+                writer.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+def create_broker():
+    """Шина по переменным окружения CHAT_BROKER (memory/unix) и CHAT_BUS_DIR"""
+    kind = os.environ.get('CHAT_BROKER', 'memory')
+    if kind == 'unix':
+        return UnixSocketBroker(os.environ.get('CHAT_BUS_DIR', '/tmp/chat-bus'))
+    if kind == 'memory':
+        return MemoryBroker()
+    raise ValueError(f"Неизвестный тип шины: {kind}")
\ No newline at end of file
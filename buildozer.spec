@@ -5,7 +5,7 @@ package.domain = org.chatapp
 source.dir = .
 source.include_exts = py,png,jpg,jpeg,kv,atlas,json
 version = 1.0
-requirements = python3,kivy==2.2.1,kivymd==1.1.1,pillow,plyer,sqlite3
+requirements = python3,kivy==2.2.1,kivymd==1.1.1,pillow,plyer,sqlite3,websocket-client
 
 # Иконка и сплеш
 presplash.filename = %(source.dir)s/assets/default_avatar.png
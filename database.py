@@ -2,12 +2,234 @@ import os
 from datetime import datetime
 import sqlite3
 import shutil
-from kivymd.app import MDApp
+import asyncio
+import functools
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from security import hash_password, verify_password
+from utils import load_settings
+
+@dataclass
+class DatabaseConfig:
+    """Настройки подключения к SQLite"""
+    path: str = 'chat.db'
+    journal_mode: str = 'WAL'
+    synchronous: str = 'NORMAL'
+    mmap_size: int = 64 * 1024 * 1024  # байт
+    cache_size: int = -8000  # отрицательное значение - размер в КиБ
+    busy_timeout: int = 5000  # мс
+    readers: int = 4  # потоков чтения у AsyncDatabase
+    kdf_workers: int = 2  # потоков хэширования паролей у AsyncDatabase
+
+    @classmethod
+    def load(cls, settings_path='settings.json'):
+        """Читает секцию "database" из файла настроек, если она есть"""
+        return load_settings(cls, 'database', settings_path)
+
+class ConnectionPool:
+    """Одно подключение для записи и отдельные подключения на чтение для каждого потока.
+
+    В режиме WAL читатели не ждут писателя, поэтому загрузка истории
+    и профилей не выстраивается в очередь за записью сообщений.
+    """
+    def __init__(self, config):
+        self.config = config
+        self._local = threading.local()
+        self._readers = []
+        self._lock = threading.Lock()
+        # Писатель используется одним потоком за раз (главный поток клиента
+        # или поток-писатель AsyncDatabase), но может быть создан в другом
+        self.writer = self._connect()
+
+    def _connect(self):
+        config = self.config
+        conn = sqlite3.connect(
+            config.path,
+            timeout=config.busy_timeout / 1000,
+            check_same_thread=False
+        )
+        conn.execute(f'PRAGMA journal_mode = {config.journal_mode}')
+        conn.execute(f'PRAGMA synchronous = {config.synchronous}')
+        conn.execute(f'PRAGMA mmap_size = {int(config.mmap_size)}')
+        conn.execute(f'PRAGMA cache_size = {int(config.cache_size)}')
+        conn.execute(f'PRAGMA busy_timeout = {int(config.busy_timeout)}')
+        return conn
+
+    def open_reader(self):
+        """Отдельное подключение на чтение, закрывает вызывающий"""
+        conn = self._connect()
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def open_writer(self):
+        """Отдельное подключение для записи из другого потока, закрывает вызывающий"""
+        return self._connect()
+
+    def reader(self):
+        """Подключение на чтение для текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            conn.execute('PRAGMA query_only = ON')
+            with self._lock:
+                self._readers.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            conn.close()
+        self.writer.close()
+
+# Миграции схемы. Версия базы хранится в PRAGMA user_version и равна
+# числу примененных миграций, каждая миграция - список SQL-команд
+MIGRATIONS = [
+    # 1: индексы для выборки последних сообщений и сообщений пользователя
+    [
+        'CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp, id)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id)',
+    ],
+    # 2: хранилище аватаров с адресацией по содержимому и подсчетом ссылок
+    [
+        '''CREATE TABLE IF NOT EXISTS avatar_blobs (
+            hash TEXT PRIMARY KEY,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            released_at DATETIME DEFAULT NULL
+        )''',
+        'ALTER TABLE users ADD COLUMN avatar_hash TEXT DEFAULT NULL',
+        'CREATE INDEX IF NOT EXISTS idx_avatar_blobs_released ON avatar_blobs (released_at) WHERE refcount <= 0',
+    ],
+    # 3: комнаты; все существующие сообщения попадают в общую комнату
+    [
+        '''CREATE TABLE IF NOT EXISTS rooms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )''',
+        "INSERT OR IGNORE INTO rooms (id, name) VALUES (1, 'Общий')",
+        'ALTER TABLE messages ADD COLUMN room_id INTEGER NOT NULL DEFAULT 1 REFERENCES rooms (id)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_room ON messages (room_id, id)',
+    ],
+    # 4: личные переписки; их сообщения лежат вне комнат (room_id = 0)
+    [
+        '''CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_low INTEGER NOT NULL REFERENCES users (id),
+            user_high INTEGER NOT NULL REFERENCES users (id),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (user_low, user_high)
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_conversations_high ON conversations (user_high)',
+        'ALTER TABLE messages ADD COLUMN conversation_id INTEGER DEFAULT NULL REFERENCES conversations (id)',
+        '''CREATE INDEX IF NOT EXISTS idx_messages_conversation
+           ON messages (conversation_id, id) WHERE conversation_id IS NOT NULL''',
+    ],
+    # 5: полнотекстовый поиск; индекс хранит только токены, текст берется из messages
+    [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+        END''',
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ],
+    # 6: id сообщения на клиенте для подтверждения и очередь неотправленных сообщений клиента
+    [
+        'ALTER TABLE messages ADD COLUMN client_id TEXT DEFAULT NULL',
+        '''CREATE INDEX IF NOT EXISTS idx_messages_client
+           ON messages (user_id, client_id) WHERE client_id IS NOT NULL''',
+        '''CREATE TABLE IF NOT EXISTS outbox (
+            client_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            text TEXT NOT NULL,
+            room_id INTEGER,
+            peer_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        )''',
+    ],
+    # 7: журнал изменений профилей для синхронизации клиентов. На пользователя
+    # одна строка; при изменении она заменяется строкой с новым seq
+    # (AUTOINCREMENT не выдает seq повторно), кэш профилей и курсоры клиента
+    [
+        '''CREATE TABLE IF NOT EXISTS profile_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL UNIQUE
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS profile_changes_insert AFTER INSERT ON users BEGIN
+            INSERT OR REPLACE INTO profile_changes (user_id) VALUES (new.id);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS profile_changes_update
+           AFTER UPDATE OF username, avatar_path, bio ON users BEGIN
+            INSERT OR REPLACE INTO profile_changes (user_id) VALUES (new.id);
+        END''',
+        'INSERT OR IGNORE INTO profile_changes (user_id) SELECT id FROM users ORDER BY id',
+        '''CREATE TABLE IF NOT EXISTS user_profiles (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            avatar_path TEXT DEFAULT NULL,
+            bio TEXT DEFAULT ''
+        )''',
+        '''CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )''',
+    ],
+    # 8: сообщения хранят только user_id, имя и аватар берутся из справочника
+    # пользователей (UserDirectory). Имена авторов, которых нет в users,
+    # сохраняем в кэше профилей; клиент заново получает все профили.
+    # DROP COLUMN требует SQLite 3.35+
+    [
+        '''INSERT OR IGNORE INTO user_profiles (id, username)
+           SELECT user_id, MAX(username) FROM messages
+           WHERE user_id IS NOT NULL AND user_id NOT IN (SELECT id FROM users)
+           GROUP BY user_id''',
+        "DELETE FROM sync_state WHERE key = 'profiles_since'",
+        'ALTER TABLE messages DROP COLUMN username',
+        'ALTER TABLE outbox DROP COLUMN username',
+    ],
+]
+
+# Миграции локального кэша клиента (Database.migrate_cache), версия - в sync_state.
+# На сервере не применяются: там messages - сами данные, а не кэш
+CACHE_MIGRATIONS = [
+    # 1: до кэша клиент хранил сообщения и переписки с локальными id и user_id,
+    # которые совпадают с id сервера. Такие строки сбрасываем вместе с курсором,
+    # следующая синхронизация заполнит кэш заново
+    [
+        'DELETE FROM messages',
+        'DELETE FROM conversations',
+        "DELETE FROM sync_state WHERE key = 'since_id'",
+    ],
+]
+
+# Комната, в которую попадают сообщения без явного room_id
+DEFAULT_ROOM_ID = 1
+# Сколько сообщений синхронизации записывать одним executemany
+SYNC_APPLY_BATCH = 500
+# room_id личных сообщений: такой комнаты нет, поэтому они не попадают в историю комнат
+DIRECT_ROOM_ID = 0
 
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('chat.db')
-        self.create_tables()
+    def __init__(self, config=None, init_schema=True):
+        self.config = config or DatabaseConfig()
+        self.pool = ConnectionPool(self.config)
+        self.conn = self.pool.writer
+        if init_schema:
+            self.create_tables()
 
         if not os.path.exists('avatars'):
             os.makedirs('avatars')
@@ -48,9 +270,52 @@ class Database:
             ''', ('test', 'test@test.com', 'test123'))
         
         self.conn.commit()
+        self.migrate()
+
+    def migrate(self):
+        """Применение недостающих миграций схемы"""
+        cursor = self.conn.cursor()
+        while True:
+            # BEGIN IMMEDIATE не дает двум процессам применить одну миграцию дважды,
+            # а в режиме WAL читатели продолжают работать во время миграции
+            cursor.execute('BEGIN IMMEDIATE')
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                self.conn.commit()
+                return
+            try:
+                for statement in MIGRATIONS[version]:
+                    cursor.execute(statement)
+                cursor.execute(f'PRAGMA user_version = {version + 1}')
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+
+    def migrate_cache(self):
+        """Применение недостающих миграций локального кэша (только на клиенте)"""
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            row = cursor.execute("SELECT value FROM sync_state WHERE key = 'cache_version'").fetchone()
+            version = row[0] if row else 0
+            for statements in CACHE_MIGRATIONS[version:]:
+                for statement in statements:
+                    cursor.execute(statement)
+            cursor.execute('''
+                INSERT OR REPLACE INTO sync_state (key, value) VALUES ('cache_version', ?)
+            ''', (max(version, len(CACHE_MIGRATIONS)),))
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
 
     def register_user(self, username, email, password):
         """Регистрация нового пользователя"""
+        return self.create_user(username, email, hash_password(password))
+
+    def create_user(self, username, email, password_hash):
+        """Создание пользователя с уже вычисленным хэшем пароля"""
         cursor = self.conn.cursor()
         try:
             # Проверяем, существует ли пользователь
@@ -63,7 +328,7 @@ class Database:
             cursor.execute('''
                 INSERT INTO users (username, email, password)
                 VALUES (?, ?, ?)
-            ''', (username, email, password))
+            ''', (username, email, password_hash))
             
             self.conn.commit()
             return True, None
@@ -73,13 +338,37 @@ class Database:
 
     def login_user(self, email, password):
         """Вход пользователя"""
-        cursor = self.conn.cursor()
+        credentials = self.get_credentials(email)
+        if credentials is None:
+            return None
+        user_id, stored = credentials
+        matches, outdated = verify_password(password, stored)
+        if not matches:
+            return None
+        if outdated:
+            # Старая запись (пароль в открытом виде или устаревший KDF) - пересчитываем
+            self.set_password_hash(user_id, hash_password(password))
+        return self.get_user(user_id)
+
+    def get_credentials(self, email):
+        """(id, хэш пароля) пользователя по email или None"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute('SELECT id, password FROM users WHERE email = ?', (email,))
+        return cursor.fetchone()
+
+    def set_password_hash(self, user_id, password_hash):
+        self.conn.execute('UPDATE users SET password = ? WHERE id = ?', (password_hash, user_id))
+        self.conn.commit()
+
+    def get_user(self, user_id):
+        """Данные пользователя после входа"""
+        cursor = self.pool.reader().cursor()
         try:
             cursor.execute('''
                 SELECT id, username, email, avatar_path, bio 
                 FROM users 
-                WHERE email = ? AND password = ?
-            ''', (email, password))
+                WHERE id = ?
+            ''', (user_id,))
             
             user = cursor.fetchone()
             if user:
@@ -92,47 +381,44 @@ class Database:
                 }
             return None
         except Exception as e:
-            print(f"Error in login_user: {e}")  # Для отладки
+            print(f"Error in get_user: {e}")  # Для отладки
             return None
 
-    def save_message(self, user_id, username, text):
-        """Сохранение сообщения"""
+    def save_message(self, user_id, text, room_id=DEFAULT_ROOM_ID, conversation_id=None, client_id=None):
+        """Сохранение сообщения в комнату или, если задан conversation_id, в личную переписку"""
+        if conversation_id is not None:
+            room_id = DIRECT_ROOM_ID
         cursor = self.conn.cursor()
         cursor.execute('''
-            INSERT INTO messages (user_id, username, text)
-            VALUES (?, ?, ?)
-        ''', (user_id, username, text))
+            INSERT INTO messages (user_id, text, room_id, conversation_id, client_id)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, text, room_id, conversation_id, client_id))
         self.conn.commit()
+        return cursor.lastrowid
 
-    def get_messages(self):
-        """Получение сообщений с аватарами"""
+    def save_messages(self, messages):
+        """Сохранение пачки сообщений (user_id, text, room_id, conversation_id,
+        client_id) одной транзакцией, возвращает их (id, timestamp)"""
         cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT m.id, m.user_id, m.username, m.text, m.timestamp, u.avatar_path
-            FROM messages m
-            LEFT JOIN users u ON m.user_id = u.id
-            ORDER BY m.timestamp DESC
-            LIMIT 100
-        ''')
-        
-        app = MDApp.get_running_app()
-        messages = []
-        for row in cursor.fetchall():
-            # Используем аватар по умолчанию из приложения
-            avatar_path = row[5] if row[5] and os.path.exists(row[5]) else app.default_avatar
-            messages.append({
-                'id': row[0],
-                'user_id': row[1],
-                'username': row[2],
-                'text': row[3],
-                'timestamp': row[4],
-                'avatar_path': avatar_path
-            })
-        
-        return messages
+        try:
+            # RETURNING отдает время, записанное в базу (CURRENT_TIMESTAMP, UTC)
+            saved = [
+                cursor.execute('''
+                    INSERT INTO messages (user_id, text, room_id, conversation_id, client_id)
+                    VALUES (?, ?, ?, ?, ?)
+                    RETURNING id, timestamp
+                ''', message).fetchone()
+                for message in messages
+            ]
+            self.conn.commit()
+        except sqlite3.Error:
+            # Иначе уже вставленные строки пачки закоммитит следующая
+            self.conn.rollback()
+            raise
+        return saved
 
-    def update_profile(self, user_id, username=None, bio=None, avatar_path=None):
-        """Обновление профиля пользователя"""
+    def update_profile(self, user_id, username=None, bio=None):
+        """Обновление профиля пользователя (аватар меняется через update_avatar)"""
         cursor = self.conn.cursor()
         updates = []
         params = []
@@ -143,9 +429,6 @@ class Database:
         if bio is not None:
             updates.append("bio = ?")
             params.append(bio)
-        if avatar_path:
-            updates.append("avatar_path = ?")
-            params.append(avatar_path)
             
         if updates:
             query = f"UPDATE users SET {', '.join(updates)} WHERE id = ?"
@@ -160,7 +443,7 @@ class Database:
 
     def get_user_profile(self, user_id):
         """Получение профиля пользователя"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute('''
             SELECT id, username, email, avatar_path, bio 
             FROM users 
@@ -180,45 +463,100 @@ class Database:
 
     def change_password(self, user_id, old_password, new_password):
         """Изменение пароля пользователя"""
-        cursor = self.conn.cursor()
+        stored = self.get_password_hash(user_id)
+        if stored is None or not verify_password(old_password, stored)[0]:
+            return False, "Неверный текущий пароль"
+        self.set_password_hash(user_id, hash_password(new_password))
+        return True, None
+
+    def get_password_hash(self, user_id):
+        cursor = self.pool.reader().cursor()
         cursor.execute('SELECT password FROM users WHERE id = ?', (user_id,))
         result = cursor.fetchone()
-        
-        if result and result[0] == old_password:
-            cursor.execute('UPDATE users SET password = ? WHERE id = ?',
-                         (new_password, user_id))
-            self.conn.commit()
-            return True, None
-        return False, "Неверный текущий пароль"
+        return result[0] if result else None
     
-    def update_avatar(self, user_id, new_avatar_path):
-        """Обновление аватара пользователя"""
+    def update_avatar(self, user_id, avatar_hash, avatar_path):
+        """Обновление аватара пользователя.
+
+        Файлы аватаров общие для всех, кто загрузил то же изображение,
+        поэтому здесь только меняются счетчики ссылок. Файлы, на которые
+        больше никто не ссылается, удаляет AvatarStore.collect_garbage.
+        """
         try:
-            # Получаем текущий аватар
             cursor = self.conn.cursor()
-            cursor.execute('SELECT avatar_path FROM users WHERE id = ?', (user_id,))
+            cursor.execute('SELECT avatar_hash FROM users WHERE id = ?', (user_id,))
             result = cursor.fetchone()
+            if result is None:
+                return False
+            old_hash = result[0]
             
-            if result and result[0]:
-                # Удаляем старый файл аватара
-                old_avatar = result[0]
-                if os.path.exists(old_avatar) and 'default_avatar' not in old_avatar:
-                    os.remove(old_avatar)
+            if old_hash != avatar_hash:
+                cursor.execute('''
+                    INSERT INTO avatar_blobs (hash, refcount) VALUES (?, 1)
+                    ON CONFLICT (hash) DO UPDATE SET refcount = refcount + 1, released_at = NULL
+                ''', (avatar_hash,))
+                if old_hash:
+                    cursor.execute('''
+                        UPDATE avatar_blobs
+                        SET refcount = refcount - 1,
+                            released_at = CASE WHEN refcount <= 1 THEN CURRENT_TIMESTAMP END
+                        WHERE hash = ?
+                    ''', (old_hash,))
             
-            # Обновляем путь к аватару в базе данных
             cursor.execute(
-                'UPDATE users SET avatar_path = ? WHERE id = ?',
-                (new_avatar_path, user_id)
+                'UPDATE users SET avatar_hash = ?, avatar_path = ? WHERE id = ?',
+                (avatar_hash, avatar_path, user_id)
             )
             self.conn.commit()
             return True
         except Exception as e:
+            self.conn.rollback()
             print(f"Error updating avatar: {e}")
             return False
 
+    def release_unused_avatars(self, grace_period, remove_files):
+        """Удаляет аватары без ссылок старше grace_period секунд, возвращает их хэши.
+
+        Каждый хэш освобождается в своей транзакции записи, и remove_files(хэш)
+        удаляет файлы внутри нее: update_avatar в это время ждет, поэтому
+        сослаться на удаляемые файлы заново нельзя. Если remove_files вернул
+        False (файлы только что использованы повторно), запись остается.
+        """
+        cursor = self.conn.cursor()
+        cutoff = f'-{int(grace_period)} seconds'
+        cursor.execute('''
+            SELECT hash FROM avatar_blobs
+            WHERE refcount <= 0 AND released_at <= datetime('now', ?)
+        ''', (cutoff,))
+        released = []
+        for avatar_hash in [row[0] for row in cursor.fetchall()]:
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                # Счетчик перепроверяется под блокировкой: аватар могли назначить снова
+                cursor.execute('DELETE FROM avatar_blobs WHERE hash = ? AND refcount <= 0', (avatar_hash,))
+                if cursor.rowcount and remove_files(avatar_hash):
+                    self.conn.commit()
+                    released.append(avatar_hash)
+                else:
+                    self.conn.rollback()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return released
+
+    def get_avatar_hashes(self):
+        """Хэши всех аватаров, известных базе"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute('SELECT hash FROM avatar_blobs')
+        return {row[0] for row in cursor.fetchall()}
+
+    def close(self):
+        """Закрывает все подключения к базе"""
+        self.pool.close()
+
     def get_user_avatar(self, user_id):
         """Получение пути к аватару пользователя"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute('SELECT avatar_path FROM users WHERE id = ?', (user_id,))
         result = cursor.fetchone()
         
@@ -228,27 +566,661 @@ class Database:
         # Возвращаем путь к аватару по умолчанию
         return 'assets/default_avatar.png'
 
-    def get_messages(self):
-        """Получение сообщений с аватарами"""
-        cursor = self.conn.cursor()
+    def get_messages(self, before_id=None, limit=100, room_id=DEFAULT_ROOM_ID, conversation_id=None):
+        """Получение страницы сообщений комнаты (или личной переписки) от новых к старым.
+
+        Постраничная выборка по ключу: before_id - id самого старого уже
+        загруженного сообщения, поэтому любая страница читается из индекса
+        (room_id, id) или (conversation_id, id) за одинаковое время
+        независимо от размера истории. Имена и аватары авторов сюда не
+        входят - они берутся из справочника пользователей.
+        """
+        cursor = self.pool.reader().cursor()
+        if conversation_id is not None:
+            where = 'WHERE m.conversation_id = ?'
+            params = [conversation_id]
+        else:
+            where = 'WHERE m.room_id = ?'
+            params = [room_id]
+        if before_id is not None:
+            where += ' AND m.id < ?'
+            params.append(before_id)
+        params.append(limit)
+        cursor.execute(f'''
+            SELECT m.id, m.user_id, m.text, m.timestamp, m.room_id, m.conversation_id, m.client_id
+            FROM messages m
+            {where}
+            ORDER BY m.id DESC
+            LIMIT ?
+        ''', params)
+        
+        return [self._message_from_row(row) for row in cursor.fetchall()]
+
+    def get_messages_since(self, last_id, limit=500, room_id=DEFAULT_ROOM_ID, conversation_id=None):
+        """Получение сообщений комнаты (или личной переписки) новее last_id, от старых к новым"""
+        cursor = self.pool.reader().cursor()
+        if conversation_id is not None:
+            where, key = 'm.conversation_id = ?', conversation_id
+        else:
+            where, key = 'm.room_id = ?', room_id
+        cursor.execute(f'''
+            SELECT m.id, m.user_id, m.text, m.timestamp, m.room_id, m.conversation_id, m.client_id
+            FROM messages m
+            WHERE {where} AND m.id > ?
+            ORDER BY m.id
+            LIMIT ?
+        ''', (key, last_id, limit))
+        
+        return [self._message_from_row(row) for row in cursor.fetchall()]
+
+    def _message_from_row(self, row):
+        return {
+            'id': row[0],
+            'user_id': row[1],
+            'text': row[2],
+            'timestamp': row[3],
+            'room_id': row[4],
+            'conversation_id': row[5],
+            'client_id': row[6]
+        }
+
+    def find_message_by_client_id(self, user_id, client_id):
+        """Уже сохраненное сообщение пользователя по id, выданному клиентом"""
+        cursor = self.pool.reader().cursor()
         cursor.execute('''
-            SELECT m.id, m.user_id, m.username, m.text, m.timestamp, u.avatar_path
+            SELECT m.id, m.user_id, m.text, m.timestamp, m.room_id, m.conversation_id, m.client_id
             FROM messages m
-            LEFT JOIN users u ON m.user_id = u.id
-            ORDER BY m.timestamp DESC
-            LIMIT 100
-        ''')
+            WHERE m.user_id = ? AND m.client_id = ?
+        ''', (user_id, client_id))
+        row = cursor.fetchone()
+        return self._message_from_row(row) if row else None
+
+    def cache_messages(self, messages):
+        """Сохранение сообщений сервера в локальный кэш истории с их серверными id"""
+        self._cache_messages(self.conn.cursor(), messages)
+        self.conn.commit()
+
+    def _cache_messages(self, cursor, messages):
+        for message in messages:
+            # Для личных сообщений запоминаем переписку с ее серверным id
+            if message.get('conversation_id') is not None and message.get('to') is not None:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO conversations (id, user_low, user_high) VALUES (?, ?, ?)
+                ''', (message['conversation_id'],
+                      min(message['user_id'], message['to']), max(message['user_id'], message['to'])))
+        # UPSERT, а не REPLACE: обновление вызывает триггер поискового индекса.
+        # Обновляются все столбцы: строка с тем же id - это то же сообщение сервера
+        cursor.executemany('''
+            INSERT INTO messages (id, user_id, text, timestamp, room_id, conversation_id, client_id)
+            VALUES (:id, :user_id, :text, :timestamp, :room_id, :conversation_id, :client_id)
+            ON CONFLICT (id) DO UPDATE SET
+                user_id = excluded.user_id,
+                text = excluded.text,
+                timestamp = excluded.timestamp,
+                room_id = excluded.room_id,
+                conversation_id = excluded.conversation_id,
+                client_id = excluded.client_id
+        ''', [
+            {
+                'id': message['id'],
+                'user_id': message['user_id'],
+                'text': message['text'],
+                'timestamp': message['timestamp'],
+                'room_id': DIRECT_ROOM_ID if message.get('conversation_id') is not None
+                           else message.get('room_id', DEFAULT_ROOM_ID),
+                'conversation_id': message.get('conversation_id'),
+                'client_id': message.get('client_id')
+            }
+            for message in messages
+        ])
+
+    def iter_changes(self, user_id, since_id=0, profiles_since=0, chunk_size=500, recent=None):
+        """Изменения для синхронизации клиента порциями до chunk_size записей.
+
+        Сначала профили, измененные после profiles_since, затем сообщения
+        комнат и личных переписок пользователя новее since_id. Читается один
+        снимок базы через отдельное подключение, строки берутся из курсора
+        порциями, поэтому память не зависит от объема изменений. При
+        since_id=0 и заданном recent сообщения начинаются с recent последних.
+        """
+        conn = self.pool.open_reader()
+        try:
+            conn.execute('BEGIN')
+            if not since_id and recent:
+                # Граница по первичному ключу: читается не больше recent строк индекса
+                row = conn.execute(
+                    'SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?', (recent,)
+                ).fetchone()
+                if row:
+                    since_id = row[0]
+            cursor = conn.execute('''
+                SELECT p.seq, u.id, u.username, u.avatar_path, u.bio
+                FROM profile_changes p
+                JOIN users u ON u.id = p.user_id
+                WHERE p.seq > ?
+                ORDER BY p.seq
+            ''', (profiles_since,))
+            for rows in iter(lambda: cursor.fetchmany(chunk_size), []):
+                yield [
+                    {
+                        'type': 'profile',
+                        'seq': row[0],
+                        'id': row[1],
+                        'username': row[2],
+                        'avatar_path': row[3],
+                        'bio': row[4]
+                    }
+                    for row in rows
+                ]
+            
+            cursor = conn.execute('''
+                SELECT m.id, m.user_id, m.text, m.timestamp, m.room_id, m.conversation_id, m.client_id,
+                       CASE WHEN c.user_low = m.user_id THEN c.user_high ELSE c.user_low END
+                FROM messages m
+                LEFT JOIN conversations c ON c.id = m.conversation_id
+                WHERE m.id > ? AND (m.conversation_id IS NULL OR c.user_low = ? OR c.user_high = ?)
+                ORDER BY m.id
+            ''', (since_id, user_id, user_id))
+            for rows in iter(lambda: cursor.fetchmany(chunk_size), []):
+                chunk = []
+                for row in rows:
+                    message = self._message_from_row(row)
+                    message['type'] = 'message'
+                    if row[7] is not None:
+                        message['to'] = row[7]
+                    chunk.append(message)
+                yield chunk
+        finally:
+            conn.close()
+
+    def apply_changes(self, records):
+        """Применение потока изменений с сервера одной транзакцией.
+
+        records - итератор записей /sync, последняя - с типом 'end' и новыми
+        курсорами. Если поток оборвался раньше, ничего не сохраняется и
+        возвращается None, иначе - число примененных записей.
+        """
+        # Отдельное подключение: применение идет в фоновом потоке
+        conn = self.pool.open_writer()
+        try:
+            cursor = conn.cursor()
+            applied = 0
+            end = None
+            # Сообщения пишем пачками ограниченного размера
+            messages = []
+            for record in records:
+                record_type = record.get('type')
+                if record_type == 'message':
+                    messages.append(record)
+                    if len(messages) >= SYNC_APPLY_BATCH:
+                        self._cache_messages(cursor, messages)
+                        messages = []
+                elif record_type == 'profile':
+                    self._cache_profiles(cursor, [record])
+                elif record_type == 'end':
+                    end = record
+                    break
+                applied += 1
+            if end is None:
+                conn.rollback()
+                return None
+            if messages:
+                self._cache_messages(cursor, messages)
+            cursor.executemany(
+                'INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)',
+                [('since_id', end['since_id']), ('profiles_since', end['profiles_since'])]
+            )
+            conn.commit()
+            return applied
+        finally:
+            conn.close()
+
+    def get_sync_state(self):
+        """Курсоры последней синхронизации: (since_id, profiles_since)"""
+        # Вызывается из фоновых потоков синхронизации, каждый раз новых, поэтому
+        # не берем подключение потока из пула - оно осталось бы открытым
+        conn = self.pool.open_reader()
+        try:
+            state = dict(conn.execute('SELECT key, value FROM sync_state').fetchall())
+        finally:
+            conn.close()
+        return state.get('since_id', 0), state.get('profiles_since', 0)
+
+    def trim_message_cache(self, keep):
+        """Оставляет в локальном кэше по keep последних сообщений каждой комнаты и переписки"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            DELETE FROM messages WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (
+                        PARTITION BY room_id, conversation_id ORDER BY id DESC
+                    ) AS position
+                    FROM messages
+                )
+                WHERE position > ?
+            )
+        ''', (keep,))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def add_to_outbox(self, client_id, user_id, text, room_id, peer_id, created_at):
+        """Постановка сообщения в очередь на отправку"""
+        self.conn.execute('''
+            INSERT INTO outbox (client_id, user_id, text, room_id, peer_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (client_id, user_id, text, room_id, peer_id, created_at))
+        self.conn.commit()
+
+    def get_outbox(self, user_id):
+        """Неподтвержденные сообщения пользователя в порядке отправки"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute('''
+            SELECT client_id, user_id, text, room_id, peer_id, status, attempts, created_at
+            FROM outbox
+            WHERE user_id = ?
+            ORDER BY rowid
+        ''', (user_id,))
+        return [
+            {
+                'client_id': row[0],
+                'user_id': row[1],
+                'text': row[2],
+                'room_id': row[3],
+                'to': row[4],
+                'status': row[5],
+                'attempts': row[6],
+                'timestamp': row[7]
+            }
+            for row in cursor.fetchall()
+        ]
+
+    def mark_outbox_sent(self, client_ids, max_attempts):
+        """Учет попытки отправки; после max_attempts сообщение считается неотправленным"""
+        self.conn.executemany('''
+            UPDATE outbox
+            SET attempts = attempts + 1,
+                status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END
+            WHERE client_id = ?
+        ''', [(max_attempts, client_id) for client_id in client_ids])
+        self.conn.commit()
+
+    def set_outbox_status(self, client_id, status):
+        self.conn.execute('UPDATE outbox SET status = ? WHERE client_id = ?', (status, client_id))
+        self.conn.commit()
+
+    def retry_outbox(self, user_id):
+        """Возврат неотправленных сообщений пользователя в очередь"""
+        # attempts не обнуляем: сервер должен проверить, не сохранено ли сообщение
+        self.conn.execute('''
+            UPDATE outbox SET status = 'pending', attempts = MIN(attempts, 1)
+            WHERE user_id = ? AND status = 'failed'
+        ''', (user_id,))
+        self.conn.commit()
+
+    def remove_from_outbox(self, client_id):
+        """Удаление подтвержденного сервером сообщения, возвращает True, если оно было в очереди"""
+        cursor = self.conn.cursor()
+        cursor.execute('DELETE FROM outbox WHERE client_id = ?', (client_id,))
+        self.conn.commit()
+        return cursor.rowcount > 0
+
+    def get_or_create_conversation(self, user_id, other_id):
+        """id личной переписки двух пользователей, при необходимости создает ее"""
+        # Пара хранится упорядоченной, чтобы у двух пользователей была одна переписка
+        pair = (min(user_id, other_id), max(user_id, other_id))
+        cursor = self.conn.cursor()
+        cursor.execute('INSERT OR IGNORE INTO conversations (user_low, user_high) VALUES (?, ?)', pair)
+        cursor.execute('SELECT id FROM conversations WHERE user_low = ? AND user_high = ?', pair)
+        conversation_id = cursor.fetchone()[0]
+        self.conn.commit()
+        return conversation_id
+
+    def find_conversation(self, user_id, other_id):
+        """id личной переписки двух пользователей или None, если ее еще нет"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute('''
+            SELECT id FROM conversations WHERE user_low = ? AND user_high = ?
+        ''', (min(user_id, other_id), max(user_id, other_id)))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def is_conversation_member(self, conversation_id, user_id):
+        """Участвует ли пользователь в личной переписке"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute('''
+            SELECT 1 FROM conversations WHERE id = ? AND (user_low = ? OR user_high = ?)
+        ''', (conversation_id, user_id, user_id))
+        return cursor.fetchone() is not None
+
+    def get_conversations(self, user_id):
+        """Личные переписки пользователя с именами собеседников"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute('''
+            SELECT c.id, u.id, u.username
+            FROM conversations c
+            JOIN users u ON u.id = CASE WHEN c.user_low = ? THEN c.user_high ELSE c.user_low END
+            WHERE c.user_low = ? OR c.user_high = ?
+            ORDER BY c.id
+        ''', (user_id, user_id, user_id))
+        return [
+            {'id': row[0], 'user_id': row[1], 'username': row[2]}
+            for row in cursor.fetchall()
+        ]
+
+    def get_users(self):
+        """Список пользователей для начала личной переписки"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute('SELECT id, username FROM users ORDER BY username')
+        return [{'id': row[0], 'username': row[1]} for row in cursor.fetchall()]
+
+    def get_directory(self, user_ids=None, cached=False):
+        """Справочник пользователей {id: (имя, путь аватара)} для UserDirectory.
+
+        Без user_ids - все пользователи одним запросом. cached - на клиенте:
+        только профили, полученные с сервера (user_profiles); локальные
+        записи users туда не попадают, их id не совпадают с серверными.
+        """
+        cursor = self.pool.reader().cursor()
+        where, params = '', []
+        if user_ids is not None:
+            params = list(user_ids)
+            if not params:
+                return {}
+            where = f"WHERE id IN ({', '.join('?' * len(params))})"
+        table = 'user_profiles' if cached else 'users'
+        cursor.execute(f'SELECT id, username, avatar_path FROM {table} {where}', params)
+        return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+    def cache_profiles(self, profiles):
+        """Сохранение профилей, пришедших с сервера, в локальный кэш"""
+        self._cache_profiles(self.conn.cursor(), profiles)
+        self.conn.commit()
+
+    def _cache_profiles(self, cursor, profiles):
+        cursor.executemany('''
+            INSERT INTO user_profiles (id, username, avatar_path, bio) VALUES (?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                username = excluded.username,
+                avatar_path = excluded.avatar_path,
+                bio = COALESCE(excluded.bio, bio)
+        ''', [
+            (profile['id'], profile['username'], profile.get('avatar_path'), profile.get('bio'))
+            for profile in profiles
+        ])
+
+    def create_room(self, name):
+        """Создание комнаты, возвращает (id, ошибка)"""
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('INSERT INTO rooms (name) VALUES (?)', (name,))
+            self.conn.commit()
+            return cursor.lastrowid, None
+        except sqlite3.IntegrityError:
+            return None, "Комната с таким названием уже существует"
+
+    def room_exists(self, room_id):
+        cursor = self.pool.reader().cursor()
+        cursor.execute('SELECT 1 FROM rooms WHERE id = ?', (room_id,))
+        return cursor.fetchone() is not None
+
+    def get_rooms(self):
+        """Список комнат"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute('SELECT id, name FROM rooms ORDER BY id')
+        return [{'id': row[0], 'name': row[1]} for row in cursor.fetchall()]
+
+    def search_messages(self, query, limit=50, before_id=None, room_id=None,
+                        highlight=('[b]', '[/b]')):
+        """Полнотекстовый поиск по сообщениям комнат.
+
+        Результаты упорядочены по релевантности (bm25), у каждого есть
+        фрагмент текста с выделенными совпадениями. before_id ограничивает
+        поиск сообщениями старше него, room_id - одной комнатой. Личные
+        переписки в поиск не попадают.
+        """
+        match = fts_query(query)
+        if not match:
+            return []
+        where = ['messages_fts MATCH ?', 'm.conversation_id IS NULL']
+        params = [highlight[0], highlight[1], match]
+        if before_id is not None:
+            # Ограничение по rowid FTS5 применяет прямо в индексе
+            where.append('messages_fts.rowid < ?')
+            params.append(before_id)
+        if room_id is not None:
+            where.append('m.room_id = ?')
+            params.append(room_id)
+        params.append(limit)
         
-        messages = []
-        for row in cursor.fetchall():
-            avatar_path = row[5] if row[5] and os.path.exists(row[5]) else 'assets/default_avatar.png'
-            messages.append({
+        cursor = self.pool.reader().cursor()
+        cursor.execute(f'''
+            SELECT m.id, m.user_id, m.text, m.timestamp, m.room_id, r.name,
+                   snippet(messages_fts, 0, ?, ?, '…', 12)
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            LEFT JOIN rooms r ON r.id = m.room_id
+            WHERE {' AND '.join(where)}
+            ORDER BY messages_fts.rank
+            LIMIT ?
+        ''', params)
+        return [
+            {
                 'id': row[0],
                 'user_id': row[1],
-                'username': row[2],
-                'text': row[3],
-                'timestamp': row[4],
-                'avatar_path': avatar_path
-            })
-        
-        return messages
\ No newline at end of file
+                'text': row[2],
+                'timestamp': row[3],
+                'room_id': row[4],
+                'room_name': row[5],
+                'snippet': row[6]
+            }
+            for row in cursor.fetchall()
+        ]
+
+
+def fts_query(text):
+    """Запрос FTS5 из строки пользователя: каждое слово ищется как префикс.
+
+    Слова берутся в кавычки, поэтому операторы и спецсимволы FTS5 во
+    вводе не ломают запрос.
+    """
+    terms = ['"' + word.replace('"', '""') + '"*' for word in text.split()]
+    return ' '.join(terms)
+
+
+class MessageBatcher:
+    """Групповая запись сообщений.
+
+    Сообщения копятся в буфере и записываются одной транзакцией, когда
+    набирается max_batch штук или проходит max_delay секунд. Каждый
+    вызывающий получает результат записи своей строки после коммита пачки.
+    """
+    def __init__(self, write_batch, max_batch=256, max_delay=0.005):
+        self._write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending = []  # (строка, future)
+        self._timer = None
+        self._tasks = set()
+
+    def submit(self, row):
+        """Добавляет строку в буфер и возвращает future с ее id"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((row, future))
+        if len(self._pending) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self.flush)
+        return future
+
+    def flush(self):
+        """Отправляет накопленную пачку на запись"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._write(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, batch):
+        try:
+            ids = await self._write_batch([row for row, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # Пачка откачена целиком; пишем строки по одной, чтобы ошибку
+            # получил только автор плохой строки
+            for item in batch:
+                await self._write([item])
+            return
+        for (_, future), message_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(message_id)
+
+    async def drain(self):
+        """Записывает все, что осталось в буфере"""
+        self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class AsyncDatabase:
+    """Асинхронная обертка над Database для сервера.
+
+    Вся работа с SQLite выполняется вне event loop: записи идут через
+    один поток-писатель, чтение - через пул потоков со своими подключениями.
+    """
+    def __init__(self, config=None, batch_size=256, batch_delay=0.005):
+        config = config or DatabaseConfig()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=config.readers, thread_name_prefix='db-reader')
+        # KDF паролей занимает десятки мс CPU; hashlib отпускает GIL, поэтому
+        # хватает потоков. Отдельный пул ограничивает число одновременных
+        # вычислений: всплеск входов ждет в очереди, а не занимает читателей
+        self._kdf = ThreadPoolExecutor(max_workers=config.kdf_workers, thread_name_prefix='db-kdf')
+        # Схема создается в потоке писателя, читатели берут подключения из пула
+        self._db = self._writer.submit(Database, config).result()
+        self._batcher = MessageBatcher(
+            functools.partial(self._write, 'save_messages'),
+            max_batch=batch_size,
+            max_delay=batch_delay
+        )
+
+    async def _write(self, method, *args, **kwargs):
+        call = functools.partial(getattr(self._db, method), *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._writer, call)
+
+    async def _read(self, method, *args, **kwargs):
+        call = functools.partial(getattr(self._db, method), *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._readers, call)
+
+    async def _run_kdf(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._kdf, func, *args)
+
+    async def register_user(self, username, email, password):
+        password_hash = await self._run_kdf(hash_password, password)
+        return await self._write('create_user', username, email, password_hash)
+
+    async def login_user(self, email, password):
+        credentials = await self._read('get_credentials', email)
+        if credentials is None:
+            # Тратим то же время, что и на проверку, чтобы не выдавать, есть ли такой email
+            await self._run_kdf(hash_password, password)
+            return None
+        user_id, stored = credentials
+        matches, outdated = await self._run_kdf(verify_password, password, stored)
+        if not matches:
+            return None
+        if outdated:
+            password_hash = await self._run_kdf(hash_password, password)
+            await self._write('set_password_hash', user_id, password_hash)
+        return await self._read('get_user', user_id)
+
+    async def get_user(self, user_id):
+        return await self._read('get_user', user_id)
+
+    async def save_message(self, user_id, text, room_id=DEFAULT_ROOM_ID, conversation_id=None, client_id=None):
+        """Сохраняет сообщение в составе пачки, возвращает его (id, timestamp)"""
+        if conversation_id is not None:
+            room_id = DIRECT_ROOM_ID
+        return await self._batcher.submit((user_id, text, room_id, conversation_id, client_id))
+
+    async def find_message_by_client_id(self, user_id, client_id):
+        return await self._read('find_message_by_client_id', user_id, client_id)
+
+    async def get_messages(self, before_id=None, limit=100, room_id=DEFAULT_ROOM_ID, conversation_id=None):
+        return await self._read('get_messages', before_id, limit, room_id, conversation_id)
+
+    async def get_messages_since(self, last_id, limit=500, room_id=DEFAULT_ROOM_ID, conversation_id=None):
+        return await self._read('get_messages_since', last_id, limit, room_id, conversation_id)
+
+    async def get_or_create_conversation(self, user_id, other_id):
+        return await self._write('get_or_create_conversation', user_id, other_id)
+
+    async def is_conversation_member(self, conversation_id, user_id):
+        return await self._read('is_conversation_member', conversation_id, user_id)
+
+    async def get_conversations(self, user_id):
+        return await self._read('get_conversations', user_id)
+
+    async def create_room(self, name):
+        return await self._write('create_room', name)
+
+    async def room_exists(self, room_id):
+        return await self._read('room_exists', room_id)
+
+    async def get_rooms(self):
+        return await self._read('get_rooms')
+
+    async def search_messages(self, query, limit=50, before_id=None, room_id=None, highlight=('[b]', '[/b]')):
+        return await self._read('search_messages', query, limit, before_id, room_id, highlight)
+
+    async def iter_changes(self, user_id, since_id=0, profiles_since=0, chunk_size=500, recent=None):
+        """Асинхронный итератор по порциям изменений (см. Database.iter_changes)"""
+        changes = self._db.iter_changes(user_id, since_id, profiles_since, chunk_size, recent)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # У генератора свое подключение, поэтому его можно продвигать из любого потока
+                chunk = await loop.run_in_executor(self._readers, next, changes, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            await loop.run_in_executor(self._readers, changes.close)
+
+    async def update_profile(self, user_id, username=None, bio=None):
+        return await self._write('update_profile', user_id, username, bio)
+
+    async def get_user_profile(self, user_id):
+        return await self._read('get_user_profile', user_id)
+
+    async def update_avatar(self, user_id, avatar_hash, avatar_path):
+        return await self._write('update_avatar', user_id, avatar_hash, avatar_path)
+
+    async def get_directory(self, user_ids=None):
+        return await self._read('get_directory', user_ids)
+
+    async def change_password(self, user_id, old_password, new_password):
+        stored = await self._read('get_password_hash', user_id)
+        if stored is None or not (await self._run_kdf(verify_password, old_password, stored))[0]:
+            return False, "Неверный текущий пароль"
+        password_hash = await self._run_kdf(hash_password, new_password)
+        await self._write('set_password_hash', user_id, password_hash)
+        return True, None
+
+    async def flush(self):
+        """Дожидается записи всех буферизованных сообщений"""
+        await self._batcher.drain()
+
+    def close(self):
+        """Дожидается завершения операций и останавливает потоки"""
+        self._kdf.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self._db.close()
\ No newline at end of file
@@ -0,0 +1,57 @@
+# Имя для автора, профиль которого еще не получен
+UNKNOWN_USERNAME = '…'
+
+class UserDirectory:
+    """Справочник пользователей в памяти: user_id -> (имя, путь аватара).
+
+    Сообщения хранят только user_id, имя и аватар автора берутся отсюда
+    при показе, поэтому переименование сразу видно во всей истории, а
+    выборка истории обходится без JOIN с users. Справочник загружается
+    из БД целиком одним запросом и обновляется событиями изменения
+    профиля. Путь аватара содержит хэш файла и служит версией аватара.
+    """
+    def __init__(self, users=None):
+        self._users = dict(users or {})
+
+    def load(self, users):
+        """Замена содержимого результатом Database.get_directory"""
+        self._users = dict(users)
+
+    def update(self, user_id, username, avatar_path=None):
+        self._users[user_id] = (username, avatar_path)
+
+    def update_many(self, users):
+        self._users.update(users)
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def username(self, user_id, default=UNKNOWN_USERNAME):
+        entry = self._users.get(user_id)
+        return entry[0] if entry else default
+
+    def avatar_path(self, user_id):
+        entry = self._users.get(user_id)
+        return entry[1] if entry else None
+
+    def missing(self, user_ids):
+        """Те из user_ids, которых нет в справочнике"""
+        return {user_id for user_id in user_ids if user_id not in self._users}
+
+    def entries(self, user_ids):
+        """Профили перечисленных пользователей для ответов API"""
+        return [
+            {'id': user_id, 'username': self._users[user_id][0], 'avatar_path': self._users[user_id][1]}
+            for user_id in sorted(set(user_ids))
+            if user_id in self._users
+        ]
+
+    def users(self):
+        """Все пользователи, отсортированные по имени"""
+        return sorted(
+            ({'id': user_id, 'username': username} for user_id, (username, _) in self._users.items()),
+            key=lambda user: user['username'].lower()
+        )
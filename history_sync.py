@@ -0,0 +1,77 @@
+import json
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+import zlib
+from kivy.clock import Clock
+from kivy.logger import Logger
+
+# Размер блока чтения ответа
+READ_SIZE = 64 * 1024
+
+class HistorySync:
+    """Догрузка всего пропущенного с сервера одним запросом /sync.
+
+    Ответ читается и разжимается потоково во временный файл, так что память
+    не зависит от объема, а затем применяется к локальной БД одной
+    транзакцией: блокировка записи не держится, пока идет загрузка.
+    Курсоры хранятся в той же БД и сдвигаются только вместе с данными.
+    Первая синхронизация получает только initial_limit последних сообщений,
+    более старые загружаются с сервера при прокрутке.
+    """
+    def __init__(self, base_url, db, timeout=30, initial_limit=1000):
+        self.base_url = base_url.rstrip('/')
+        self.db = db
+        self.timeout = timeout
+        self.initial_limit = initial_limit
+        self._running = threading.Lock()
+
+    def start(self, token, on_done=None):
+        """Синхронизация в фоновом потоке; on_done(число записей или None)
+        вызывается в главном потоке. Повторный вызов во время работы игнорируется."""
+        if not self._running.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                applied = self.run(token)
+            finally:
+                self._running.release()
+            if on_done is not None:
+                Clock.schedule_once(lambda dt: on_done(applied))
+        threading.Thread(target=run, name='history-sync', daemon=True).start()
+
+    def run(self, token):
+        """Блокирующая синхронизация; возвращает число примененных записей или None"""
+        since_id, profiles_since = self.db.get_sync_state()
+        query = urllib.parse.urlencode({
+            'since_id': since_id,
+            'profiles_since': profiles_since,
+            'recent': self.initial_limit
+        })
+        request = urllib.request.Request(f'{self.base_url}/sync?{query}')
+        request.add_header('Accept-Encoding', 'gzip')
+        request.add_header('Authorization', f'Bearer {token}')
+        try:
+            with tempfile.TemporaryFile() as spool:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    gzipped = response.headers.get('Content-Encoding') == 'gzip'
+                    self._download(response, gzipped, spool)
+                spool.seek(0)
+                # Оборванный поток без записи end apply_changes откатит
+                return self.db.apply_changes(json.loads(line) for line in spool if line.strip())
+        except (OSError, ValueError) as e:
+            Logger.warning(f"HistorySync: ошибка синхронизации: {e}")
+            return None
+
+    def _download(self, response, gzipped, spool):
+        # wbits=31 - поток в формате gzip
+        decompressor = zlib.decompressobj(31) if gzipped else None
+        while True:
+            block = response.read(READ_SIZE)
+            if not block:
+                break
+            if decompressor is not None:
+                block = decompressor.decompress(block)
+            spool.write(block)
\ No newline at end of file
@@ -1,25 +1,98 @@
+from startup import StartupTimer
+# Отсчет начинаем до импорта Kivy, чтобы он попал в отчет
+startup = StartupTimer()
+
 from kivymd.app import MDApp
-from kivy.uix.screenmanager import ScreenManager
-from screens.login_screen import LoginScreen
-from screens.register_screen import RegisterScreen
-from screens.chat_screen import ChatScreen
-from screens.profile_screen import ProfileScreen
-from database import Database
 from kivy.storage.jsonstore import JsonStore
-from kivy.metrics import dp
+from kivy.metrics import dp, Metrics
 from kivy.core.window import Window
-from utils import create_default_avatar
+from kivy.clock import Clock
+from kivy.logger import Logger
+from screens import LazyScreenManager
+from utils import DEFAULT_AVATAR_PATH
+import functools
+import threading
+
+startup.mark('imports')
+
+DEFAULT_SERVER_URL = 'ws://localhost:8000'
+# Как часто удалять неиспользуемые файлы аватаров, секунд
+AVATAR_GC_INTERVAL = 3600
+# Сколько последних сообщений каждой комнаты и переписки хранить в локальном кэше
+MESSAGE_CACHE_SIZE = 1000
+
+def lazy_service(factory):
+    """Сервис приложения, который создается при первом обращении.
+
+    Создание защищено блокировкой: сервис может понадобиться и главному
+    потоку, и фоновому прогреву одновременно. Модули сервисов
+    импортируются внутри фабрик, чтобы не замедлять запуск.
+    """
+    name = factory.__name__
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def get(self):
+        value = self.__dict__.get(name)
+        if value is None:
+            with lock:
+                value = self.__dict__.get(name)
+                if value is None:
+                    value = self.__dict__[name] = factory(self)
+        return value
+    return property(get)
 
 class ChatApp(MDApp):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.db = Database()
         self.settings_store = JsonStore('settings.json')
-        self.default_avatar = create_default_avatar()
+        # Файл создается при фоновом прогреве после первого кадра
+        self.default_avatar = DEFAULT_AVATAR_PATH
+        # Медиафайлы и синхронизацию сервер отдает по HTTP на том же адресе, что и WebSocket
+        self.http_url = 'http' + self.get_server_url()[len('ws'):]
         self.current_user = None
+        # Сессия на сервере: (user_id на сервере, токен); без нее нет WebSocket и синхронизации
+        self.session = None
+        self.transport = None
+        self._transport_callbacks = None
         
         Window.minimum_width = dp(300)
         Window.minimum_height = dp(500)
+        startup.mark('app init')
+
+    @lazy_service
+    def db(self):
+        from database import Database, DatabaseConfig
+        db = Database(DatabaseConfig.load())
+        # Локальная история - кэш сообщений сервера
+        db.migrate_cache()
+        return db
+
+    @lazy_service
+    def avatar_cache(self):
+        from avatar_cache import AvatarCache
+        from media_cache import MediaCache
+        return AvatarCache(self.default_avatar, media_cache=MediaCache(self.http_url))
+
+    @lazy_service
+    def avatar_store(self):
+        from avatar_store import AvatarStore
+        return AvatarStore(self.db, scale=Metrics.density)
+
+    @lazy_service
+    def user_directory(self):
+        from directory import UserDirectory
+        return UserDirectory(self.db.get_directory(cached=True))
+
+    @lazy_service
+    def outbox(self):
+        from outbox import Outbox
+        return Outbox(self.db)
+
+    @lazy_service
+    def history_sync(self):
+        from history_sync import HistorySync
+        return HistorySync(self.http_url, self.db)
 
     def build(self):
         try:
@@ -31,13 +104,167 @@ class ChatApp(MDApp):
         self.theme_cls.theme_style = theme_style
         self.theme_cls.primary_palette = "Blue"
         
-        sm = ScreenManager()
-        sm.add_widget(LoginScreen(name='login'))
-        sm.add_widget(RegisterScreen(name='register'))
-        sm.add_widget(ChatScreen(name='chat'))
-        sm.add_widget(ProfileScreen(name='profile'))
+        # Экраны создаются при первом переходе на них
+        sm = LazyScreenManager()
+        sm.register('login', 'screens.login_screen:LoginScreen')
+        sm.register('register', 'screens.register_screen:RegisterScreen')
+        sm.register('chat', 'screens.chat_screen:ChatScreen')
+        sm.register('profile', 'screens.profile_screen:ProfileScreen')
+        sm.current = 'login'
+        
+        # Сборка мусора аватаров в фоне: вскоре после запуска и затем периодически
+        Clock.schedule_once(lambda dt: self.avatar_store.start_gc(), 10)
+        Clock.schedule_interval(lambda dt: self.avatar_store.start_gc(), AVATAR_GC_INTERVAL)
+        # Локальная история - кэш серверной, ее размер ограничен
+        Clock.schedule_once(lambda dt: self.start_cache_trim(), 10)
+        
+        Window.bind(on_flip=self.on_first_frame)
+        startup.mark('build')
         return sm
 
+    def on_first_frame(self, *args):
+        """Первый кадр показан: отчет о запуске и прогрев в фоне"""
+        Window.unbind(on_flip=self.on_first_frame)
+        startup.mark('first frame')
+        startup.report()
+        threading.Thread(target=self.warm_up, name='warm-up', daemon=True).start()
+
+    def warm_up(self):
+        """Подготовка того, что понадобится после входа: БД (с миграциями),
+        справочник пользователей и аватар по умолчанию"""
+        from utils import create_default_avatar
+        try:
+            create_default_avatar()
+            self.user_directory
+        except Exception as e:
+            Logger.warning(f"App: ошибка фоновой инициализации: {e}")
+
+    def start_cache_trim(self):
+        """Обрезка локального кэша истории в фоновом потоке со своим подключением"""
+        from database import Database
+
+        def run():
+            db = Database(self.db.config, init_schema=False)
+            try:
+                db.trim_message_cache(MESSAGE_CACHE_SIZE)
+            except Exception as e:
+                Logger.warning(f"App: ошибка обрезки кэша истории: {e}")
+            finally:
+                db.close()
+        threading.Thread(target=run, name='cache-trim', daemon=True).start()
+
+    def open_session(self, email, password):
+        """Получение сессионного токена сервера в фоне.
+
+        Локальный вход уже выполнен, поэтому приложение работает и без
+        сервера; подключение начнется, когда токен будет получен.
+        """
+        from transport import request_session
+
+        def run():
+            session = request_session(self.http_url, email, password)
+            if session is not None:
+                Clock.schedule_once(lambda dt: self.on_session(session))
+        threading.Thread(target=run, name='session', daemon=True).start()
+
+    def on_session(self, session):
+        # Пользователь мог выйти, пока шел запрос
+        if getattr(self, 'current_user', None) is None:
+            return
+        self.session = session
+        if self._transport_callbacks is not None and self.transport is None:
+            self.start_transport(*self._transport_callbacks)
+
+    def server_user_id(self):
+        """id пользователя на сервере или None без сессии.
+
+        Локальная учетная запись (current_user) имеет свой id в локальной БД,
+        а сообщения, переписки и справочник используют id сервера.
+        """
+        return self.session[0] if self.session is not None else None
+
+    def fetch(self, path, params, on_done):
+        """Запрос к API сервера в фоне; on_done(ответ или None) вызывается в главном потоке"""
+        from transport import request_json
+        if self.session is None:
+            on_done(None)
+            return
+        token = self.session[1]
+
+        def run():
+            result = request_json(self.http_url, path, params, token)
+            if result is not None and result.get('status') != 'success':
+                result = None
+            Clock.schedule_once(lambda dt: on_done(result))
+        threading.Thread(target=run, name='fetch', daemon=True).start()
+
+    def push_profile(self, username, bio):
+        """Отправка измененного профиля на сервер в фоне; остальные клиенты
+        получат его событием 'profile'"""
+        from transport import send_profile
+        if self.session is None:
+            return
+        token = self.session[1]
+
+        def run():
+            success, error = send_profile(self.http_url, token, username, bio)
+            if not success and error:
+                Logger.warning(f"App: сервер отклонил изменение профиля: {error}")
+        threading.Thread(target=run, name='profile', daemon=True).start()
+
+    def push_avatar(self, file_path):
+        """Загрузка нового аватара на сервер в фоне; остальные клиенты
+        получат его событием 'profile'"""
+        from transport import upload_avatar
+        if self.session is None:
+            return
+        token = self.session[1]
+
+        def run():
+            try:
+                success, error = upload_avatar(self.http_url, token, file_path)
+            except OSError as e:
+                success, error = False, str(e)
+            if not success and error:
+                Logger.warning(f"App: сервер не принял аватар: {error}")
+        threading.Thread(target=run, name='avatar', daemon=True).start()
+
+    def close_session(self):
+        self.stop_transport()
+        self.session = None
+        self._transport_callbacks = None
+
+    def start_transport(self, on_message, on_connect=None):
+        """Подключение к серверу для получения сообщений в реальном времени"""
+        from transport import ChatTransport
+        self.stop_transport()
+        self._transport_callbacks = (on_message, on_connect)
+        if self.session is None:
+            return
+        user_id, token = self.session
+        self.transport = ChatTransport(
+            f"{self.get_server_url()}/ws/{user_id}",
+            on_message=on_message,
+            on_connect=on_connect,
+            token=token
+        )
+        self.transport.start()
+
+    def get_server_url(self):
+        """Адрес сервера (ws:// или wss://) из настроек"""
+        try:
+            return self.settings_store.get('server')['url']
+        except KeyError:
+            return DEFAULT_SERVER_URL
+
+    def stop_transport(self):
+        if self.transport is not None:
+            self.transport.stop()
+            self.transport = None
+
+    def on_stop(self):
+        self.stop_transport()
+
     def toggle_theme(self):
         """Переключение темы и сохранение настройки"""
         self.theme_cls.theme_style = (
@@ -0,0 +1,73 @@
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from utils import AVATAR_FILE_NAME
+
+class MediaCache:
+    """Дисковый кэш файлов с сервера (аватаров).
+
+    Для каждого файла хранится его ETag: повторная загрузка идет с
+    If-None-Match и при ответе 304 не передает тело. Файлы с хэшем
+    содержимого в имени неизменны, поэтому после первой загрузки
+    сервер вообще не запрашивается.
+    """
+    def __init__(self, base_url, directory=os.path.join('cache', 'media'), timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.directory = directory
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(directory, 'index.json')
+        
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        try:
+            with open(self._index_path, encoding='utf-8') as f:
+                self._etags = json.load(f)
+        except (OSError, ValueError):
+            self._etags = {}
+
+    def fetch(self, remote_path):
+        """Локальный путь к файлу сервера, например 'avatars/<имя>'.
+
+        Скачивает файл при необходимости; вызов блокирующий, только для
+        фоновых потоков. Возвращает None, если файла нет ни в кэше, ни на сервере.
+        """
+        name = remote_path.replace('/', '_')
+        local_path = os.path.join(self.directory, name)
+        etag = self._etags.get(name)
+        cached = etag is not None and os.path.exists(local_path)
+        if cached and AVATAR_FILE_NAME.match(os.path.basename(remote_path)):
+            return local_path
+        
+        request = urllib.request.Request(f'{self.base_url}/media/{remote_path}')
+        if cached:
+            request.add_header('If-None-Match', etag)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = response.read()
+                new_etag = response.headers.get('ETag')
+        except urllib.error.HTTPError as e:
+            # 304 - файл в кэше актуален
+            if e.code != 304:
+                print(f"Error fetching {remote_path}: HTTP {e.code}")
+            return local_path if cached else None
+        except OSError as e:
+            print(f"Error fetching {remote_path}: {e}")
+            return local_path if cached else None
+        
+        # Пишем во временный файл, чтобы не оставить недокачанный
+        temp_path = local_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, local_path)
+        
+        with self._lock:
+            if new_etag:
+                self._etags[name] = new_etag
+            else:
+                self._etags.pop(name, None)
+            with open(self._index_path, 'w', encoding='utf-8') as f:
+                json.dump(self._etags, f)
+        return local_path
\ No newline at end of file
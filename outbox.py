@@ -0,0 +1,105 @@
+import time
+import uuid
+from datetime import datetime, timezone
+from protocol import TIMESTAMP_FORMAT
+
+# Статусы сообщений на клиенте
+STATUS_PENDING = 'pending'
+STATUS_FAILED = 'failed'
+STATUS_SENT = 'sent'
+
+class Outbox:
+    """Очередь исходящих сообщений клиента.
+
+    Сообщение сначала сохраняется в локальной БД и сразу показывается,
+    а отправляется, когда есть соединение, пачками. Сервер возвращает
+    client_id в разосланном сообщении - по нему сообщение подтверждается
+    и удаляется из очереди. Очередь переживает перезапуск приложения.
+    Отправленное сообщение считается в пути и повторно отправляется только
+    после переподключения или если подтверждение не пришло за timeout секунд.
+    """
+    def __init__(self, db, batch_size=50, max_attempts=5, timeout=30):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self._in_flight = {}  # client_id: время отправки
+
+    def add(self, user, text, room_id=None, peer_id=None):
+        """Постановка сообщения в очередь; возвращает его для показа в списке"""
+        entry = {
+            'client_id': uuid.uuid4().hex,
+            'user_id': user['id'],
+            'text': text,
+            'room_id': room_id if peer_id is None else None,
+            'to': peer_id,
+            'status': STATUS_PENDING,
+            'attempts': 0,
+            # Время в UTC, как CURRENT_TIMESTAMP, которое сервер вернет при подтверждении
+            'timestamp': datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+        }
+        self.db.add_to_outbox(
+            entry['client_id'], entry['user_id'], text, entry['room_id'], peer_id, entry['timestamp']
+        )
+        return entry
+
+    def pending(self, user_id):
+        """Все неподтвержденные сообщения пользователя, включая неотправленные"""
+        return self.db.get_outbox(user_id)
+
+    def flush(self, transport, user_id, resend=False):
+        """Отправка ожидающих сообщений, кроме тех, что уже в пути;
+        resend - после переподключения отправить заново и их.
+        Возвращает число отправленных"""
+        if transport is None or not transport.connected:
+            return 0
+        if resend:
+            self._in_flight.clear()
+        now = time.monotonic()
+        entries = [
+            entry for entry in self.pending(user_id)
+            if entry['status'] == STATUS_PENDING
+            and now - self._in_flight.get(entry['client_id'], -self.timeout) >= self.timeout
+        ]
+        sent = 0
+        for start in range(0, len(entries), self.batch_size):
+            batch = entries[start:start + self.batch_size]
+            frames = [self.frame(entry) for entry in batch]
+            frame = frames[0] if len(frames) == 1 else {'type': 'batch', 'messages': frames}
+            if not transport.send(frame):
+                break
+            client_ids = [entry['client_id'] for entry in batch]
+            self.db.mark_outbox_sent(client_ids, self.max_attempts)
+            self._in_flight.update((client_id, now) for client_id in client_ids)
+            sent += len(batch)
+        return sent
+
+    def frame(self, entry):
+        # Отправителя сервер берет из сессии подключения
+        frame = {
+            'client_id': entry['client_id'],
+            'text': entry['text'],
+            # Сервер проверит, не сохранено ли сообщение с прошлой попытки
+            'retry': entry['attempts'] > 0
+        }
+        if entry['to'] is not None:
+            frame.update(type='dm', to=entry['to'])
+        else:
+            frame.update(type='message', room_id=entry['room_id'])
+        return frame
+
+    def acknowledge(self, message):
+        """Подтверждение сообщением от сервера; True, если оно было в очереди"""
+        client_id = message.get('client_id')
+        if client_id is None:
+            return False
+        self._in_flight.pop(client_id, None)
+        return self.db.remove_from_outbox(client_id)
+
+    def fail(self, client_id):
+        self._in_flight.pop(client_id, None)
+        self.db.set_outbox_status(client_id, STATUS_FAILED)
+
+    def retry_failed(self, user_id):
+        """Возврат неотправленных сообщений в очередь для новой попытки"""
+        self.db.retry_outbox(user_id)
\ No newline at end of file
@@ -0,0 +1,120 @@
+import json
+from datetime import datetime, timezone
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Формат времени в сообщениях (как в SQLite CURRENT_TIMESTAMP, то есть в UTC)
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Код закрытия WebSocket: подключение заменено новым подключением того же
+# пользователя, переподключаться не нужно
+CLOSE_REPLACED = 4000
+
+# Короткие ключи компактной схемы; остальные ключи передаются как есть
+SHORT_KEYS = {
+    'type': 't',
+    'id': 'i',
+    'room_id': 'r',
+    'conversation_id': 'c',
+    'user_id': 'u',
+    'username': 'n',
+    'text': 'x',
+    'timestamp': 'd',
+    'to': 'o',
+    'message': 'm',
+    'client_id': 'k',
+    'messages': 'b',
+    'retry': 'y',
+}
+LONG_KEYS = {short: key for key, short in SHORT_KEYS.items()}
+
+class Codec:
+    """Кодек кадров WebSocket.
+
+    Приложение всегда работает с обычными словарями с полными ключами,
+    а кодек отвечает только за представление на проводе. binary - какими
+    кадрами отправлять результат encode.
+    """
+    name = 'json'
+    binary = False
+
+    def encode(self, message: dict):
+        return json.dumps(message, ensure_ascii=False)
+
+    def decode(self, frame) -> dict:
+        return json.loads(frame)
+
+class CompactCodec(Codec):
+    """JSON с короткими ключами и временем в секундах эпохи"""
+    name = 'compact'
+
+    def encode(self, message: dict):
+        return json.dumps(shorten(message), ensure_ascii=False, separators=(',', ':'))
+
+    def decode(self, frame) -> dict:
+        return expand(json.loads(frame))
+
+class MsgpackCodec(Codec):
+    """MessagePack с короткими ключами, двоичные кадры"""
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, message: dict):
+        return msgpack.packb(shorten(message))
+
+    def decode(self, frame) -> dict:
+        return expand(msgpack.unpackb(frame))
+
+def shorten(message: dict) -> dict:
+    compact = {}
+    for key, value in message.items():
+        if key == 'timestamp' and isinstance(value, str):
+            # Строка в UTC, а не в местном времени сервера
+            value = int(datetime.strptime(value, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+        elif isinstance(value, list):
+            value = [shorten(item) if isinstance(item, dict) else item for item in value]
+        compact[SHORT_KEYS.get(key, key)] = value
+    return compact
+
+def expand(compact: dict) -> dict:
+    message = {}
+    for short, value in compact.items():
+        key = LONG_KEYS.get(short, short)
+        if key == 'timestamp' and isinstance(value, int):
+            value = datetime.fromtimestamp(value, timezone.utc).strftime(TIMESTAMP_FORMAT)
+        elif isinstance(value, list):
+            value = [expand(item) if isinstance(item, dict) else item for item in value]
+        message[key] = value
+    return message
+
+DEFAULT_CODEC = Codec()
+CODECS = {codec.name: codec for codec in (DEFAULT_CODEC, CompactCodec())}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+# Кодек согласуется через подпротокол WebSocket: клиент перечисляет
+# поддерживаемые в порядке предпочтения, сервер выбирает первый известный.
+# Клиент без подпротоколов получает прежний JSON
+SUBPROTOCOL_PREFIX = 'chat.'
+
+def subprotocols(names=None):
+    """Подпротоколы, которые предлагает клиент, от лучшего к худшему"""
+    names = names or [name for name in ('msgpack', 'compact') if name in CODECS]
+    return [SUBPROTOCOL_PREFIX + name for name in names]
+
+def negotiate(offered):
+    """Выбор кодека по списку подпротоколов клиента: (кодек, подпротокол или None)"""
+    for subprotocol in offered or ():
+        name = subprotocol[len(SUBPROTOCOL_PREFIX):] if subprotocol.startswith(SUBPROTOCOL_PREFIX) else None
+        if name in CODECS:
+            return CODECS[name], subprotocol
+    return DEFAULT_CODEC, None
+
+def codec_for(subprotocol):
+    """Кодек по подпротоколу, который выбрал сервер"""
+    if subprotocol and subprotocol.startswith(SUBPROTOCOL_PREFIX):
+        return CODECS.get(subprotocol[len(SUBPROTOCOL_PREFIX):], DEFAULT_CODEC)
+    return DEFAULT_CODEC
\ No newline at end of file
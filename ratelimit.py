@@ -0,0 +1,111 @@
+import math
+import time
+from dataclasses import dataclass
+from utils import load_settings
+
+# Что делать с кадром сверх лимита
+RATE_LIMIT_DROP = 'drop'  # отклоняем кадр, клиент получает ошибку
+RATE_LIMIT_DELAY = 'delay'  # ждем накопления токенов, но не дольше max_delay, иначе отклоняем
+RATE_LIMIT_DISCONNECT = 'disconnect'  # закрываем подключение
+
+@dataclass
+class RateLimitConfig:
+    """Лимиты входящих кадров WebSocket: скорость (кадров в секунду) и запас"""
+    user_rate: float = 10.0  # на пользователя, по всем его подключениям
+    user_burst: int = 100
+    connection_rate: float = 5.0  # на одно подключение
+    connection_burst: int = 60  # не меньше пачки из очереди клиента (Outbox.batch_size)
+    policy: str = RATE_LIMIT_DELAY
+    max_delay: float = 2.0  # секунд
+    sweep_interval: float = 60.0  # как часто забывать восполненные лимиты пользователей
+
+    @classmethod
+    def load(cls, settings_path='settings.json'):
+        """Читает секцию "rate_limit" из файла настроек, если она есть"""
+        return load_settings(cls, 'rate_limit', settings_path)
+
+    @property
+    def max_cost(self):
+        """Самый дорогой кадр (пачка), который вообще может пройти лимиты"""
+        return min(self.user_burst, self.connection_burst)
+
+class TokenBucket:
+    """Ведро токенов: пополняется со скоростью rate, вмещает не больше capacity.
+
+    Токены пересчитываются лениво при обращении, без таймеров.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, cost):
+        """Секунд до накопления cost токенов, 0 - уже есть, inf - не накопится
+        никогда (cost больше емкости). Вызывается после refill"""
+        if cost > self.capacity:
+            return math.inf
+        missing = cost - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, cost):
+        self.tokens -= cost
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class RateLimiter:
+    """Ограничение частоты кадров от клиентов по пользователю и по подключению.
+
+    Лимит пользователя общий для всех его подключений в процессе, так что
+    переподключение его не сбрасывает; лимит подключения хранится в самом
+    подключении и исчезает вместе с ним. Проверка - O(1): поиск в словаре
+    и арифметика над двумя ведрами. Ведра пользователей, которые успели
+    полностью восполниться, периодически удаляются - такое ведро ничем не
+    отличается от нового.
+    """
+    def __init__(self, config=None):
+        self.config = config or RateLimitConfig()
+        self._users = {}  # user_id: TokenBucket
+        self._next_sweep = time.monotonic() + self.config.sweep_interval
+
+    def connection_bucket(self):
+        """Ведро для нового подключения"""
+        config = self.config
+        return TokenBucket(config.connection_rate, config.connection_burst, time.monotonic())
+
+    def acquire(self, user_id, connection_bucket, cost=1):
+        """Списание cost токенов с обоих ведер.
+
+        Возвращает 0, если кадр можно обработать, иначе - через сколько
+        секунд появятся токены; в этом случае ничего не списывается.
+        """
+        now = time.monotonic()
+        user_bucket = self._users.get(user_id)
+        if user_bucket is None:
+            config = self.config
+            user_bucket = self._users[user_id] = TokenBucket(config.user_rate, config.user_burst, now)
+        user_bucket.refill(now)
+        connection_bucket.refill(now)
+        wait = max(user_bucket.wait_time(cost), connection_bucket.wait_time(cost))
+        if wait:
+            return wait
+        user_bucket.take(cost)
+        connection_bucket.take(cost)
+        if now >= self._next_sweep:
+            self.sweep(now)
+        return 0.0
+
+    def sweep(self, now=None):
+        """Удаление восполненных ведер пользователей"""
+        now = time.monotonic() if now is None else now
+        for user_id in [user_id for user_id, bucket in self._users.items() if bucket.is_full(now)]:
+            del self._users[user_id]
+        self._next_sweep = now + self.config.sweep_interval
@@ -0,0 +1,30 @@
+import importlib
+import time
+from kivy.logger import Logger
+from kivy.uix.screenmanager import ScreenManager
+
+class LazyScreenManager(ScreenManager):
+    """ScreenManager, создающий экраны при первом переходе на них.
+
+    Экран регистрируется строкой 'модуль:Класс', поэтому и модуль экрана
+    со всеми его зависимостями импортируется только когда экран нужен.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._factories = {}
+
+    def register(self, name, target):
+        self._factories[name] = target
+
+    def has_screen(self, name):
+        return name in self._factories or super().has_screen(name)
+
+    def get_screen(self, name):
+        target = self._factories.pop(name, None)
+        if target is not None:
+            started = time.perf_counter()
+            module_name, class_name = target.split(':')
+            screen_class = getattr(importlib.import_module(module_name), class_name)
+            self.add_widget(screen_class(name=name))
+            Logger.info(f"Screens: экран {name} создан за {(time.perf_counter() - started) * 1000:.0f} мс")
+        return super().get_screen(name)
\ No newline at end of file
@@ -1,78 +1,126 @@
 from kivy.uix.screenmanager import Screen
-from kivymd.uix.list import MDList
 from kivymd.uix.card import MDCard
+from kivymd.uix.label import MDLabel
 from kivymd.uix.textfield import MDTextField
 from kivymd.uix.button import MDIconButton, MDRaisedButton
 from kivymd.uix.toolbar import MDTopAppBar
 from kivymd.uix.dialog import MDDialog
+from kivymd.uix.list import OneLineListItem, TwoLineListItem
 from kivy.uix.boxlayout import BoxLayout
-from kivy.uix.scrollview import ScrollView
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.core.text import Label as CoreLabel
 from kivymd.app import MDApp
 from datetime import datetime
 from kivy.clock import Clock
-from kivy.metrics import dp
-from kivy.uix.image import AsyncImage
+from kivy.metrics import dp, sp
+from kivy.uix.image import Image
+from kivy.utils import escape_markup
+from database import DEFAULT_ROOM_ID
+from outbox import STATUS_PENDING, STATUS_FAILED, STATUS_SENT
+from protocol import TIMESTAMP_FORMAT
 import os
 
-class MessageCard(MDCard):
-    def __init__(self, message, is_own, **kwargs):
+# Сколько сообщений загружать за один раз
+PAGE_SIZE = 50
+# Как часто проверять, не пора ли повторить отправку неподтвержденных сообщений, секунд
+OUTBOX_CHECK_INTERVAL = 10
+# Сколько результатов поиска показывать
+SEARCH_LIMIT = 30
+# Маркеры совпадений во фрагменте: текст сообщения экранируется,
+# а маркеры затем заменяются разметкой Kivy
+SNIPPET_MARKS = ('\x02', '\x03')
+# Подписи к сообщениям, которые еще не подтвердил сервер
+STATUS_LABELS = {
+    STATUS_PENDING: " • отправляется",
+    STATUS_FAILED: " • не отправлено",
+}
+
+# Размеры строки сообщения
+LIST_PADDING = dp(10)
+ROW_PADDING = dp(10)
+ROW_SPACING = dp(10)
+AVATAR_SIZE = dp(40)
+HEADER_HEIGHT = dp(20)
+MIN_ROW_HEIGHT = dp(60)
+OWN_MESSAGE_COLOR = [0.9, 0.9, 1, 0.2]
+
+class MessageRow(RecycleDataViewBehavior, MDCard):
+    """Строка списка сообщений.
+
+    Создается только для видимых сообщений и переиспользуется при
+    прокрутке: RecycleView лишь подставляет в нее новые данные.
+    """
+    def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.orientation = 'horizontal'
         self.size_hint_y = None
-        self.height = dp(60)
-        self.padding = dp(10)
-        self.spacing = dp(10)
+        self.padding = ROW_PADDING
+        self.spacing = ROW_SPACING
         self.elevation = 0
         self.radius = [dp(10)]
-        app = MDApp.get_running_app()
+        self.default_bg_color = list(self.md_bg_color)
         
         # Аватар
-        avatar_box = BoxLayout(
-            size_hint=(None, None),
-            size=(dp(40), dp(40)),
-            padding=0
-        )
-        
-        # Проверяем наличие аватара
-        pp = MDApp.get_running_app()
-        avatar_path = message.get('avatar_path', app.default_avatar)
-        
-        self.avatar = AsyncImage(
-            source=avatar_path,
+        self.avatar_key = None
+        self.avatar_image = Image(
             size_hint=(None, None),
-            size=(dp(40), dp(40)),
-            fit_mode="cover"
+            size=(AVATAR_SIZE, AVATAR_SIZE),
+            fit_mode="cover",
+            pos_hint={'top': 1}
         )
-        avatar_box.add_widget(self.avatar)
         
         # Контент сообщения
         content = BoxLayout(orientation='vertical')
-        username = message['username']
-        time_str = datetime.strptime(message['timestamp'], '%Y-%m-%d %H:%M:%S').strftime("%H:%M")
-        
-        header = BoxLayout(size_hint_y=None, height=dp(20))
-        from kivymd.uix.label import MDLabel
-        header.add_widget(MDLabel(
-            text=f"{username} • {time_str}",
+        self.header_label = MDLabel(
             theme_text_color="Secondary",
-            font_style="Caption"
-        ))
-        
-        content.add_widget(header)
-        content.add_widget(MDLabel(
-            text=message['text'],
-            theme_text_color="Primary"
-        ))
+            font_style="Caption",
+            size_hint_y=None,
+            height=HEADER_HEIGHT
+        )
+        self.body_label = MDLabel(theme_text_color="Primary")
+        content.add_widget(self.header_label)
+        content.add_widget(self.body_label)
         
-        if is_own:
-            self.md_bg_color = [0.9, 0.9, 1, 0.2]
-            
-        self.add_widget(avatar_box)
+        self.add_widget(self.avatar_image)
         self.add_widget(content)
 
+    def refresh_view_attrs(self, rv, index, data):
+        # Текстура аватара общая для всех строк из кэша приложения
+        self.avatar_key = (data['user_id'], data['avatar_path'])
+        self.avatar_image.texture = MDApp.get_running_app().avatar_cache.get(
+            data['user_id'], data['avatar_path'], callback=self.on_avatar_loaded
+        )
+        self.header_label.text = data['header']
+        self.body_label.text = data['body']
+        self.md_bg_color = OWN_MESSAGE_COLOR if data['is_own'] else self.default_bg_color
+        return super().refresh_view_attrs(rv, index, data)
+
+    def on_avatar_loaded(self, key, texture):
+        # Строка могла уже переключиться на другое сообщение
+        if key == self.avatar_key:
+            self.avatar_image.texture = texture
+
 class ChatScreen(Screen):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.oldest_id = None  # курсор для подгрузки старых сообщений
+        self.newest_id = None  # последнее показанное сообщение для дельта-синхронизации
+        self.has_more = True
+        self.room_id = DEFAULT_ROOM_ID
+        # Собеседник в личной переписке (None - показываем комнату) и id
+        # переписки, который становится известен от сервера с первым сообщением
+        self.conversation_id = None
+        self.peer_id = None
+        # Авторы без профиля в справочнике, для которых уже запрошена синхронизация
+        self._requested_profiles = set()
+        self._profiles_trigger = Clock.create_trigger(self.sync_messages)
+        self._loading_older = False
+        # Комнаты, на которые подписано подключение, кроме общей: после
+        # переподключения сервер о них не знает
+        self._joined_rooms = set()
+        Clock.schedule_interval(self.flush_outbox, OUTBOX_CHECK_INTERVAL)
         self.setup_ui()
         
         
@@ -92,17 +140,48 @@ class ChatScreen(Screen):
                 ["theme-light-dark", lambda x: self.toggle_theme()],
                 ["account", lambda x: self.goto_profile()],
                 ["logout", lambda x: self.show_logout_dialog()],
-                ["refresh", lambda x: self.refresh_messages()]
+                ["forum", lambda x: self.show_rooms_dialog()],
+                ["message-text", lambda x: self.show_users_dialog()],
+                ["magnify", lambda x: self.toggle_search()],
+                ["refresh", lambda x: self.retry_failed()]
             ]
         )
         
         # Контейнер для содержимого
         content_layout = BoxLayout(orientation='vertical')
+        self.content_layout = content_layout
+        
+        # Строка поиска, показывается по кнопке на панели
+        self.search_bar = BoxLayout(
+            size_hint_y=None,
+            height=dp(60),
+            padding=[dp(10), 0],
+        )
+        self.search_input = MDTextField(
+            hint_text="Поиск по сообщениям",
+            multiline=False,
+            on_text_validate=self.search_messages
+        )
+        self.search_bar.add_widget(self.search_input)
         
-        # Область сообщений
-        self.scroll = ScrollView()
-        self.messages_list = MDList(spacing=dp(10), padding=dp(10))
-        self.scroll.add_widget(self.messages_list)
+        # Область сообщений: виджеты создаются только для видимых строк
+        self.messages_view = RecycleView(viewclass=MessageRow)
+        messages_layout = RecycleBoxLayout(
+            orientation='vertical',
+            spacing=dp(10),
+            padding=LIST_PADDING,
+            default_size=(None, MIN_ROW_HEIGHT),
+            default_size_hint=(1, None),
+            key_size='row_size',
+            size_hint_y=None
+        )
+        messages_layout.bind(minimum_height=messages_layout.setter('height'))
+        self.messages_view.add_widget(messages_layout)
+        # Подгружаем старые сообщения, когда пользователь докрутил до верха
+        self.messages_view.bind(scroll_y=self.on_scroll)
+        # При изменении ширины текст переносится иначе - пересчитываем высоты
+        self._relayout_trigger = Clock.create_trigger(self.relayout_rows)
+        self.messages_view.bind(width=lambda *args: self._relayout_trigger())
         
         # Область ввода
         input_layout = BoxLayout(
@@ -127,7 +206,7 @@ class ChatScreen(Screen):
         input_layout.add_widget(send_button)
         
         # Добавляем элементы в контейнер содержимого
-        content_layout.add_widget(self.scroll)
+        content_layout.add_widget(self.messages_view)
         content_layout.add_widget(input_layout)
         
         # Добавляем toolbar и контент в основной layout
@@ -142,15 +221,44 @@ class ChatScreen(Screen):
             return
 
         app = MDApp.get_running_app()
-        app.db.save_message(
-            user_id=app.current_user['id'],
-            username=app.current_user['username'],
-            text=text
-        )
-        
+        entry = app.outbox.add(app.current_user, text, room_id=self.room_id, peer_id=self.peer_id)
         self.message_input.text = ""
+        
+        # Показываем сообщение сразу; сервер сохранит его и пришлет обратно
+        # с id и временем, тогда строка станет подтвержденной
+        self.append_rows([entry])
+        self.messages_view.scroll_y = 0
+        app.outbox.flush(app.transport, app.current_user['id'])
+
+    def retry_failed(self):
+        """Повторная отправка неотправленных сообщений и обновление списка"""
+        app = MDApp.get_running_app()
+        if getattr(app, 'current_user', None):
+            app.outbox.retry_failed(app.current_user['id'])
+            app.outbox.flush(app.transport, app.current_user['id'])
         self.refresh_messages()
 
+    def load_page(self, before_id=None):
+        """Страница истории открытой комнаты или переписки из локального кэша"""
+        if self.peer_id is not None and self.conversation_id is None:
+            # Переписка еще не начата
+            return []
+        return MDApp.get_running_app().db.get_messages(
+            before_id=before_id, limit=PAGE_SIZE, room_id=self.room_id,
+            conversation_id=self.conversation_id
+        )
+
+    def in_current_chat(self, message):
+        """Относится ли сообщение (или запись очереди) к открытой комнате или переписке"""
+        if self.peer_id is not None:
+            if message.get('status', STATUS_SENT) != STATUS_SENT:
+                # Запись очереди: user_id в ней - локальная учетная запись
+                return message.get('to') == self.peer_id
+            user_id = MDApp.get_running_app().server_user_id()
+            return {message['user_id'], message.get('to')} == {user_id, self.peer_id}
+        return (message.get('conversation_id') is None and message.get('to') is None
+                and message.get('room_id', DEFAULT_ROOM_ID) == self.room_id)
+
     def refresh_messages(self, *args):
         """Обновление списка сообщений"""
         app = MDApp.get_running_app()
@@ -160,16 +268,293 @@ class ChatScreen(Screen):
             self.manager.current = 'login'
             return
             
-        messages = app.db.get_messages()
+        # История из локального кэша показывается сразу, без запроса к серверу
+        messages = self.load_page()
+        
+        # Новые сообщения внизу, поэтому выводим страницу в обратном порядке,
+        # а под ней - еще не подтвержденные сервером
+        rows = [self.make_row(message) for message in reversed(messages)]
+        rows.extend(
+            self.make_row(entry)
+            for entry in app.outbox.pending(app.current_user['id'])
+            if self.in_current_chat(entry)
+        )
+        self.messages_view.data = rows
+        
+        self.oldest_id = messages[-1]['id'] if messages else None
+        self.newest_id = messages[0]['id'] if messages else 0
+        # Неполная страница кэша не значит, что истории больше нет: она может быть на сервере
+        self.has_more = len(messages) == PAGE_SIZE or app.session is not None
+        self.messages_view.scroll_y = 0
+
+    def make_row(self, message):
+        """Данные строки списка для сообщения; автор берется из справочника пользователей"""
+        app = MDApp.get_running_app()
+        status = message.get('status', STATUS_SENT)
+        own = status != STATUS_SENT
+        if own:
+            # Запись очереди хранится под локальным id, на сервере автор - мы
+            user_id = app.server_user_id()
+        else:
+            user_id = message['user_id']
+            own = user_id == app.server_user_id()
+        if user_id is not None and user_id not in app.user_directory:
+            self.request_profile(user_id)
+        time_str = datetime.strptime(message['timestamp'], TIMESTAMP_FORMAT).strftime("%H:%M")
+        return {
+            'message_id': message.get('id'),
+            'client_id': message.get('client_id'),
+            'status': status,
+            'time_str': time_str,
+            'header': self.format_header(user_id, time_str, status),
+            'body': message['text'],
+            'user_id': user_id,
+            'avatar_path': app.user_directory.avatar_path(user_id),
+            'is_own': own,
+            'row_size': (None, self.row_height(message['text']))
+        }
+
+    def format_header(self, user_id, time_str, status):
+        app = MDApp.get_running_app()
+        if user_id is None:
+            # Свое сообщение до получения сессии
+            username = app.current_user['username']
+        else:
+            username = app.user_directory.username(user_id)
+        return f"{username} • {time_str}{STATUS_LABELS.get(status, '')}"
+
+    def refresh_headers(self, user_id=None):
+        """Новые имена и аватары в показанных строках после изменения профилей"""
+        directory = MDApp.get_running_app().user_directory
+        for row in self.messages_view.data:
+            if user_id is None or row['user_id'] == user_id:
+                row['header'] = self.format_header(row['user_id'], row['time_str'], row['status'])
+                row['avatar_path'] = directory.avatar_path(row['user_id'])
+        self.messages_view.refresh_from_data()
+
+    def request_profile(self, user_id):
+        """Профиля автора еще нет: он придет с синхронизацией, запрашиваем ее один раз"""
+        if user_id in self._requested_profiles:
+            return
+        self._requested_profiles.add(user_id)
+        self._profiles_trigger()
+
+    def row_height(self, text):
+        """Высота строки по тексту, перенесенному по ширине списка"""
+        text_width = (self.messages_view.width - 2 * LIST_PADDING - 2 * ROW_PADDING
+                      - AVATAR_SIZE - ROW_SPACING)
+        font_name, font_size = MDApp.get_running_app().theme_cls.font_styles['Body1'][:2]
+        label = CoreLabel(
+            text=text,
+            font_name=font_name,
+            font_size=sp(font_size),
+            text_size=(max(text_width, dp(50)), None)
+        )
+        label.refresh()
+        height = label.texture.size[1] + HEADER_HEIGHT + 2 * ROW_PADDING
+        return max(height, MIN_ROW_HEIGHT)
+
+    def relayout_rows(self, *args):
+        """Пересчет высот строк после изменения ширины списка"""
+        data = self.messages_view.data
+        for row in data:
+            row['row_size'] = (None, self.row_height(row['body']))
+        self.messages_view.refresh_from_data()
+
+    def append_rows(self, messages):
+        """Добавление новых сообщений в конец списка"""
+        # Прокручиваем вниз, только если пользователь и так был внизу
+        at_bottom = self.messages_view.scroll_y <= 0.01
+        self.messages_view.data.extend(self.make_row(message) for message in messages)
+        if at_bottom:
+            self.messages_view.scroll_y = 0
+
+    def replace_row(self, client_id, message):
+        """Замена строки сообщения из очереди; False, если такой строки нет"""
+        data = self.messages_view.data
+        for index, row in enumerate(data):
+            if row.get('client_id') == client_id and row['status'] != STATUS_SENT:
+                data[index] = self.make_row(message)
+                return True
+        return False
+
+    def flush_outbox(self, *args):
+        """Отправка новых сообщений очереди и тех, чье подтверждение не пришло вовремя"""
+        app = MDApp.get_running_app()
+        if getattr(app, 'current_user', None):
+            app.outbox.flush(app.transport, app.current_user['id'])
+
+    def on_connected(self):
+        """После (пере)подключения: повторная отправка всей очереди и догрузка пропущенного"""
+        app = MDApp.get_running_app()
+        if not getattr(app, 'current_user', None) or app.transport is None:
+            return
+        # Новое подключение подписано только на общую комнату
+        for room_id in self._joined_rooms:
+            app.transport.send({'type': 'join', 'room_id': room_id})
+        # Сообщения, отправленные в прошлое подключение, могли не дойти
+        app.outbox.flush(app.transport, app.current_user['id'], resend=True)
+        self.sync_messages()
+
+    def sync_messages(self, *args):
+        """Догрузка пропущенных сообщений и профилей в кэш"""
+        app = MDApp.get_running_app()
+        if not getattr(app, 'current_user', None):
+            return
+        if app.session is not None:
+            app.history_sync.start(app.session[1], on_done=self.on_history_synced)
+
+    def on_history_synced(self, applied):
+        """Показ сообщений открытой комнаты, которые пришли при синхронизации"""
+        if not applied:
+            return
+        app = MDApp.get_running_app()
+        # Вместе с сообщениями могли прийти измененные профили
+        app.user_directory.load(app.db.get_directory(cached=True))
+        self.refresh_headers()
+        if self.peer_id is not None and self.conversation_id is None:
+            # Переписка могла начаться, пока нас не было
+            self.conversation_id = app.db.find_conversation(app.server_user_id(), self.peer_id)
+            if self.conversation_id is not None:
+                self.refresh_messages()
+            return
+        if self.newest_id is None:
+            self.refresh_messages()
+            return
+        messages = app.db.get_messages_since(self.newest_id, room_id=self.room_id,
+                                             conversation_id=self.conversation_id)
+        if not messages:
+            return
+        self.newest_id = messages[-1]['id']
+        # Свои сообщения из очереди могли сохраниться до обрыва связи
+        messages = [
+            message for message in messages
+            if not (app.outbox.acknowledge(message) and self.replace_row(message['client_id'], message))
+        ]
+        self.append_rows(messages)
+
+    def on_server_message(self, message):
+        """Новое сообщение от сервера"""
+        app = MDApp.get_running_app()
+        if not getattr(app, 'current_user', None):
+            return
+        if message.get('type') == 'error':
+            # Сервер отклонил сообщение из очереди
+            client_id = message.get('client_id')
+            if client_id is not None:
+                app.outbox.fail(client_id)
+                for entry in app.outbox.pending(app.current_user['id']):
+                    if entry['client_id'] == client_id:
+                        self.replace_row(client_id, entry)
+            return
+        if message.get('type') == 'profile':
+            self.on_profile_changed(message)
+            return
+        if 'text' not in message:
+            return
+        
+        # Все сообщения сервера попадают в локальный кэш истории
+        app.db.cache_messages([message])
+        acknowledged = app.outbox.acknowledge(message)
+        if not self.in_current_chat(message) and not acknowledged:
+            return
+        if self.peer_id is not None and self.conversation_id is None:
+            self.conversation_id = message.get('conversation_id')
+        
+        # Свое сообщение из очереди подтверждаем на месте
+        if acknowledged and self.replace_row(message['client_id'], message):
+            self.newest_id = max(self.newest_id or 0, message['id'])
+            return
+        if not self.in_current_chat(message):
+            return
+        # Пропускаем сообщения, которые уже показаны
+        if self.newest_id is not None and message['id'] <= self.newest_id:
+            return
+        
+        self.append_rows([message])
+        self.newest_id = message['id']
+
+    def on_profile_changed(self, profile):
+        """Событие изменения профиля: обновляем кэш, справочник и показанные строки"""
+        app = MDApp.get_running_app()
+        app.db.cache_profiles([profile])
+        user_id = profile['id']
+        if app.user_directory.avatar_path(user_id) != profile.get('avatar_path'):
+            app.avatar_cache.invalidate(user_id)
+        app.user_directory.update(user_id, profile['username'], profile.get('avatar_path'))
+        self.refresh_headers(user_id)
+        if self.peer_id == user_id:
+            self.toolbar.title = profile['username']
+
+    def on_scroll(self, instance, scroll_y):
+        if scroll_y >= 1 and self.has_more:
+            self.load_older()
+
+    def load_older(self):
+        """Подгрузка следующей страницы старых сообщений"""
+        if self._loading_older:
+            return
+        messages = self.load_page(before_id=self.oldest_id)
+        app = MDApp.get_running_app()
+        if len(messages) == PAGE_SIZE or app.session is None:
+            self.show_older(messages, len(messages) == PAGE_SIZE)
+            return
+        # Локальный кэш ограничен - более старая история есть только на сервере
+        self._loading_older = True
+        chat = (self.room_id, self.conversation_id)
+        app.fetch('/messages', {
+            'before': self.oldest_id,
+            'limit': PAGE_SIZE,
+            'room_id': self.room_id,
+            'conversation_id': self.conversation_id
+        }, lambda result: self.on_older_fetched(chat, result, messages))
+
+    def on_older_fetched(self, chat, result, local_messages):
+        self._loading_older = False
+        if chat != (self.room_id, self.conversation_id):
+            # Пока шел запрос, открыли другую комнату
+            return
+        if result is None:
+            # Сервер недоступен - показываем то, что есть локально
+            self.show_older(local_messages, False)
+            return
+        app = MDApp.get_running_app()
+        messages = result['messages']
+        self.remember_users(result.get('users', ()))
+        app.db.cache_messages(messages)
+        self.show_older(messages, result.get('next_before') is not None)
+
+    def remember_users(self, users):
+        """Профили авторов из ответа API - в справочник"""
+        MDApp.get_running_app().user_directory.update_many(
+            {user['id']: (user['username'], user['avatar_path']) for user in users}
+        )
+
+    def show_older(self, messages, has_more):
+        """Вставка страницы старых сообщений (от новых к старым) над списком"""
+        self.has_more = has_more
+        if not messages:
+            return
         
-        self.messages_list.clear_widgets()
+        # Вставляем страницу сверху в хронологическом порядке
+        rows = [self.make_row(message) for message in reversed(messages)]
+        added_height = sum(row['row_size'][1] + dp(10) for row in rows)
+        view = self.messages_view
+        old_height = view.children[0].height if view.children else 0
+        offset_from_top = (1 - view.scroll_y) * max(old_height - view.height, 0)
         
-        for message in messages:
-            is_own = message['user_id'] == app.current_user['id']
-            message_card = MessageCard(message, is_own)
-            self.messages_list.add_widget(message_card)
+        view.data = rows + view.data
+        self.oldest_id = messages[-1]['id']
+        if not self.newest_id:
+            # Список был пуст, это первая страница
+            self.newest_id = messages[0]['id']
         
-        self.scroll.scroll_y = 0
+        # Сохраняем положение: сдвигаемся вниз на высоту вставленных строк
+        def restore_position(dt):
+            scrollable = view.children[0].height - view.height
+            if scrollable > 0:
+                view.scroll_y = 1 - min((offset_from_top + added_height) / scrollable, 1)
+        Clock.schedule_once(restore_position)
 
     def show_logout_dialog(self):
         self.dialog = MDDialog(
@@ -190,11 +575,130 @@ class ChatScreen(Screen):
 
     def logout(self, *args):
         app = MDApp.get_running_app()
+        app.close_session()
+        self._joined_rooms.clear()
         if hasattr(app, 'current_user'):
             delattr(app, 'current_user')
         self.dialog.dismiss()
         self.manager.current = 'login'
 
+    def show_rooms_dialog(self):
+        """Выбор комнаты"""
+        app = MDApp.get_running_app()
+        items = [
+            OneLineListItem(
+                text=room['name'],
+                on_release=lambda x, room=room: self.select_room(room)
+            )
+            for room in app.db.get_rooms()
+        ]
+        self.rooms_dialog = MDDialog(title="Комнаты", type="simple", items=items)
+        self.rooms_dialog.open()
+
+    def select_room(self, room):
+        self.rooms_dialog.dismiss()
+        self.open_room(room)
+
+    def open_room(self, room):
+        """Переход в комнату: загружаем только ее историю"""
+        self.room_id = room['id']
+        self.conversation_id = None
+        self.peer_id = None
+        self.toolbar.title = room['name']
+        self.refresh_messages()
+        if self.room_id != DEFAULT_ROOM_ID:
+            self._joined_rooms.add(self.room_id)
+        # Без подключения подписка уйдет в on_connected
+        app = MDApp.get_running_app()
+        if app.transport is not None:
+            app.transport.send({'type': 'join', 'room_id': self.room_id})
+
+    def show_users_dialog(self):
+        """Выбор собеседника для личной переписки"""
+        app = MDApp.get_running_app()
+        items = [
+            OneLineListItem(
+                text=user['username'],
+                on_release=lambda x, user=user: self.open_conversation(user)
+            )
+            for user in app.user_directory.users()
+            if user['id'] != app.server_user_id()
+        ]
+        self.users_dialog = MDDialog(title="Личные сообщения", type="simple", items=items)
+        self.users_dialog.open()
+
+    def open_conversation(self, user):
+        """Переход в личную переписку: загружаем только ее историю"""
+        self.users_dialog.dismiss()
+        app = MDApp.get_running_app()
+        self.conversation_id = app.db.find_conversation(app.server_user_id(), user['id'])
+        self.peer_id = user['id']
+        self.toolbar.title = user['username']
+        self.refresh_messages()
+
+    def toggle_search(self):
+        """Показать или скрыть строку поиска"""
+        if self.search_bar.parent:
+            self.content_layout.remove_widget(self.search_bar)
+        else:
+            # Новые виджеты добавляются в начало children - строка окажется сверху
+            self.content_layout.add_widget(self.search_bar, index=len(self.content_layout.children))
+            self.search_input.focus = True
+
+    def search_messages(self, *args):
+        """Поиск по сообщениям, результаты в диалоге"""
+        query = self.search_input.text.strip()
+        if not query:
+            return
+        app = MDApp.get_running_app()
+        results = app.db.search_messages(query, limit=SEARCH_LIMIT, highlight=SNIPPET_MARKS)
+        if len(results) == SEARCH_LIMIT or app.session is None:
+            self.show_search_results(results)
+            return
+        # В локальном кэше только последние сообщения - ищем и по всей истории на сервере
+        app.fetch('/search', {
+            'q': query,
+            'limit': SEARCH_LIMIT,
+            'mark_start': SNIPPET_MARKS[0],
+            'mark_end': SNIPPET_MARKS[1]
+        }, lambda result: self.on_search_fetched(result, results))
+
+    def on_search_fetched(self, result, local_results):
+        results = local_results
+        if result is not None:
+            self.remember_users(result.get('users', ()))
+            found = {item['id'] for item in result['results']}
+            results = result['results'] + [item for item in local_results if item['id'] not in found]
+        self.show_search_results(results[:SEARCH_LIMIT])
+
+    def show_search_results(self, results):
+        app = MDApp.get_running_app()
+        items = [
+            TwoLineListItem(
+                text=f"{escape_markup(app.user_directory.username(result['user_id']))} • "
+                     f"{escape_markup(result['room_name'] or '')}",
+                secondary_text=self.format_snippet(result['snippet']),
+                on_release=lambda x, result=result: self.open_search_result(result)
+            )
+            for result in results
+        ]
+        if not items:
+            items = [OneLineListItem(text="Ничего не найдено")]
+        self.search_dialog = MDDialog(title="Результаты поиска", type="simple", items=items)
+        self.search_dialog.open()
+
+    def format_snippet(self, snippet):
+        """Фрагмент с выделением совпадений разметкой Kivy"""
+        start, end = SNIPPET_MARKS
+        return escape_markup(snippet).replace(start, '[b]').replace(end, '[/b]')
+
+    def open_search_result(self, result):
+        """Переход в комнату найденного сообщения"""
+        self.search_dialog.dismiss()
+        if self.conversation_id is None and result['room_id'] == self.room_id:
+            return
+        self.open_room({'id': result['room_id'], 'name': result['room_name']})
+
     def goto_profile(self):
         self.manager.current = 'profile'
 
@@ -209,10 +713,11 @@ class ChatScreen(Screen):
             self.manager.current = 'login'
             return
             
-        # Запускаем обновление сообщений
+        # Загружаем историю, дальше новые сообщения приходят от сервера.
+        # После (пере)подключения догружаем то, что могли пропустить
         self.refresh_messages()
-        Clock.schedule_interval(self.refresh_messages, 3)
-
-    def on_leave(self):
-        """При уходе с экрана"""
-        Clock.unschedule(self.refresh_messages)
\ No newline at end of file
+        if app.transport is None:
+            app.start_transport(
+                on_message=self.on_server_message,
+                on_connect=self.on_connected
+            )
\ No newline at end of file
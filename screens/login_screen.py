@@ -23,6 +23,7 @@ class LoginScreen(Screen):
         
         if user:
             app.current_user = user
+            app.open_session(self.email.text, self.password.text)
             self.manager.current = 'chat'  # Изменено с 'register' на 'chat'
         else:
             self.show_error_dialog("Неверный email или пароль")
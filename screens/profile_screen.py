@@ -7,9 +7,10 @@ from kivymd.uix.toolbar import MDTopAppBar
 from kivymd.app import MDApp
 from kivy.uix.image import Image
 from kivy.metrics import dp
+from kivy.clock import Clock
 from plyer import filechooser
-import shutil
 from kivy.uix.image import AsyncImage
+import threading
 import os
 
 class ProfileScreen(Screen):
@@ -118,34 +119,44 @@ class ProfileScreen(Screen):
             
         file_path = selection[0]
         
-        # Создаем папку avatars, если её нет
-        if not os.path.exists('avatars'):
-            os.makedirs('avatars')
-        
-        app = MDApp.get_running_app()
         # Получаем расширение файла
         file_extension = os.path.splitext(file_path)[1].lower()
         # Проверяем, что это изображение
         if file_extension not in ['.png', '.jpg', '.jpeg']:
             self.show_error_dialog("Пожалуйста, выберите изображение (PNG, JPG)")
             return
-            
-        new_path = f'avatars/user_{app.current_user["id"]}{file_extension}'
         
+        # Уменьшение и перекодирование фото с камеры занимает время,
+        # поэтому выполняем его в фоне, не блокируя интерфейс
+        threading.Thread(target=self.ingest_avatar, args=(file_path,), daemon=True).start()
+
+    def ingest_avatar(self, file_path):
+        """Подготовка вариантов аватара (в фоновом потоке)"""
+        app = MDApp.get_running_app()
         try:
-            # Копируем файл
-            shutil.copy2(file_path, new_path)
-            # Обновляем путь к аватару в базе данных
-            app.db.update_profile(
-                user_id=app.current_user['id'],
-                avatar_path=new_path
-            )
-            # Обновляем отображение
-            self.avatar_image.source = new_path
-            # Перезагружаем изображение
-            self.avatar_image.reload()
+            avatar_hash, paths = app.avatar_store.add(file_path)
         except Exception as e:
-            self.show_error_dialog(f"Ошибка при сохранении аватара: {str(e)}")
+            error = f"Ошибка при сохранении аватара: {str(e)}"
+            Clock.schedule_once(lambda dt: self.show_error_dialog(error))
+            return
+        Clock.schedule_once(lambda dt: self.apply_avatar(avatar_hash, paths, file_path))
+
+    def apply_avatar(self, avatar_hash, paths, file_path):
+        """Сохранение готового аватара (в главном потоке) и загрузка его на сервер"""
+        app = MDApp.get_running_app()
+        if not app.avatar_store.assign(app.current_user['id'], avatar_hash, paths):
+            self.show_error_dialog("Не удалось сохранить аватар")
+            return
+        # Путь нового аватара содержит хэш, так что кэши обновятся сами,
+        # а старые текстуры пользователя можно освободить. Справочник
+        # и кэш аватаров хранят пользователей под id сервера
+        user_id = app.server_user_id()
+        if user_id is not None:
+            app.avatar_cache.invalidate(user_id)
+            app.user_directory.update(user_id, app.current_user['username'], paths['large'])
+        self.avatar_image.source = paths['large']
+        # Сервер обработает исходный файл сам и разошлет новый путь
+        app.push_avatar(file_path)
 
     def save_profile(self):
         """Сохраняем изменения профиля"""
@@ -153,12 +164,16 @@ class ProfileScreen(Screen):
         success, error = app.db.update_profile(
             user_id=app.current_user['id'],
             username=self.username.text,
-            bio=self.bio.text,
-            avatar_path=self.avatar_image.source
+            bio=self.bio.text
         )
         
         if success:
+            user_id = app.server_user_id()
             app.current_user['username'] = self.username.text
+            # Новое имя сразу видно во всей истории, другим клиентам его разошлет сервер
+            if user_id is not None:
+                app.user_directory.update(user_id, self.username.text, app.user_directory.avatar_path(user_id))
+            app.push_profile(self.username.text, self.bio.text)
             self.show_success_dialog("Профиль успешно обновлен")
         else:
             self.show_error_dialog(error)
@@ -0,0 +1,178 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from collections import OrderedDict
+
+# Параметры KDF. scrypt требует OpenSSL 1.1+, иначе используется PBKDF2
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600_000
+SALT_SIZE = 16
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, maxmem=64 * 1024 * 1024)
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+
+def hash_password(password):
+    """Хэш пароля со случайной солью в виде строки для users.password.
+
+    Формат: 'scrypt$n$r$p$соль$хэш' или 'pbkdf2_sha256$итерации$соль$хэш'.
+    Вычисляется долго (десятки мс) - на сервере только в пуле потоков KDF.
+    """
+    salt = os.urandom(SALT_SIZE)
+    if hasattr(hashlib, 'scrypt'):
+        digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        return f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}'
+    digest = _pbkdf2(password, salt, PBKDF2_ITERATIONS)
+    return f'pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64(salt)}${_b64(digest)}'
+
+def verify_password(password, stored):
+    """Проверка пароля, возвращает (совпадает, нужно ли пересчитать хэш).
+
+    Пересчитать нужно старые записи с паролем в открытом виде и хэши
+    с устаревшими параметрами.
+    """
+    algorithm, _, params = stored.partition('$')
+    try:
+        if algorithm == 'scrypt':
+            n, r, p, salt, digest = params.split('$')
+            n, r, p = int(n), int(r), int(p)
+            actual = _scrypt(password, base64.b64decode(salt), n, r, p)
+            outdated = (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        elif algorithm == 'pbkdf2_sha256':
+            iterations, salt, digest = params.split('$')
+            actual = _pbkdf2(password, base64.b64decode(salt), int(iterations))
+            # Когда scrypt доступен, PBKDF2 тоже считается устаревшим
+            outdated = int(iterations) != PBKDF2_ITERATIONS or hasattr(hashlib, 'scrypt')
+        else:
+            # Пароль, сохраненный до перехода на хэши
+            return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8')), True
+        expected = base64.b64decode(digest)
+    except ValueError:
+        # Поврежденный хэш в базе (binascii.Error - подкласс ValueError)
+        return False, False
+    matches = hmac.compare_digest(actual, expected)
+    return matches, matches and outdated
+# Сессионные токены: base64url(JSON {uid, exp}) + '.' + base64url(HMAC-SHA256).
+# Проверяются без обращения к БД, секрет общий для всех процессов сервера
+SESSION_TTL = 7 * 24 * 3600
+SECRET_FILE = 'session.key'
+# Минимальная длина секрета, байт: пустой или короткий ключ HMAC позволил бы подделать токен
+SECRET_SIZE = 32
+
+def load_secret(path=SECRET_FILE):
+    """Секрет для подписи токенов: из CHAT_SECRET или файла, который создается один раз"""
+    secret = os.environ.get('CHAT_SECRET')
+    if secret:
+        secret = secret.encode('utf-8')
+    else:
+        try:
+            with open(path, 'rb') as f:
+                secret = f.read()
+        except FileNotFoundError:
+            secret = _create_secret(path)
+    if len(secret) < SECRET_SIZE:
+        raise ValueError(f"Секрет подписи сессий короче {SECRET_SIZE} байт")
+    return secret
+
+def _create_secret(path):
+    # Секрет пишется во временный файл и ставится на место через link: при
+    # одновременном запуске нескольких процессов файл создаст один, и другие
+    # никогда не увидят его пустым или недописанным
+    secret = os.urandom(SECRET_SIZE)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secret)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            with open(path, 'rb') as f:
+                return f.read()
+    finally:
+        os.remove(temp_path)
+    return secret
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _unb64url(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def issue_token(user_id, secret, ttl=SESSION_TTL):
+    payload = _b64url(json.dumps({'uid': user_id, 'exp': int(time.time()) + ttl}).encode('utf-8'))
+    signature = _b64url(hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest())
+    return f'{payload}.{signature}'
+
+def verify_token(token, secret):
+    """user_id из действительного токена или None"""
+    claims = read_token(token, secret)
+    return claims[0] if claims else None
+
+def read_token(token, secret):
+    """(user_id, срок действия в секундах эпохи) из действительного токена или None"""
+    payload, _, signature = (token or '').partition('.')
+    try:
+        # Токен приходит от клиента: не-ASCII символы и мусор - просто недействительный токен
+        expected = _b64url(hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest())
+        if not signature or not hmac.compare_digest(signature.encode('ascii'), expected.encode('ascii')):
+            return None
+        claims = json.loads(_unb64url(payload))
+    except ValueError:
+        # UnicodeError и binascii.Error - подклассы ValueError
+        return None
+    if not isinstance(claims, dict):
+        return None
+    exp = claims.get('exp')
+    if not isinstance(exp, (int, float)) or exp < time.time():
+        return None
+    return claims.get('uid'), exp
+
+class SessionCache:
+    """Проверенные сессии: токен -> данные пользователя, с ограниченным временем жизни.
+
+    Повторные подключения с тем же токеном (переподключения клиента)
+    не проверяют подпись и не читают пользователя из БД заново.
+    """
+    def __init__(self, ttl=300, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, token):
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        identity, expires = entry
+        if expires < time.monotonic():
+            del self._entries[token]
+            return None
+        return identity
+
+    def put(self, token, identity, expires_at=None):
+        """expires_at - срок действия токена (время эпохи): дольше него сессия в кэше не живет"""
+        now = time.monotonic()
+        expires = now + self.ttl
+        if expires_at is not None:
+            expires = min(expires, now + expires_at - time.time())
+        self._entries[token] = (identity, expires)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard_user(self, user_id):
+        """Забыть сессии пользователя, например после смены имени"""
+        for token in [token for token, (identity, _) in self._entries.items() if identity['id'] == user_id]:
+            del self._entries[token]
\ No newline at end of file
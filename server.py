@@ -1,69 +1,720 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from typing import List, Dict
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from typing import List, Dict, Optional, Set, Tuple, Union
 import uvicorn
-from database import Database
-from datetime import datetime
+from database import AsyncDatabase, DatabaseConfig, DEFAULT_ROOM_ID, DIRECT_ROOM_ID
+from broker import create_broker
+from directory import UserDirectory
+from protocol import CLOSE_REPLACED, Codec, negotiate
+from ratelimit import RATE_LIMIT_DELAY, RATE_LIMIT_DISCONNECT, RateLimitConfig, RateLimiter, TokenBucket
+from security import SessionCache, issue_token, load_secret, read_token
+from utils import AVATAR_FILE_NAME, process_avatar
 import json
+import asyncio
+import os
+import re
+import mimetypes
+import sqlite3
+import tempfile
+import zlib
 
 app = FastAPI()
-db = Database()
+db = AsyncDatabase(DatabaseConfig.load())
+# Секрет подписи сессионных токенов и уже проверенные сессии
+session_secret = load_secret()
+sessions = SessionCache()
+# Ограничение частоты кадров от клиентов
+limiter = RateLimiter(RateLimitConfig.load())
+
+# Максимальная длина текста сообщения, символов
+MAX_TEXT_LENGTH = 4000
+
+# Политики для медленных клиентов, у которых переполнилась очередь
+SLOW_CLIENT_DROP = 'drop'  # отключаем клиента
+SLOW_CLIENT_SKIP = 'skip'  # пропускаем сообщения, пока клиент не догонит
+
+class Connection:
+    """Подключение с собственной очередью исходящих сообщений"""
+    def __init__(self, websocket: WebSocket, user_id: int, queue_size: int, codec: Codec):
+        self.websocket = websocket
+        # Пользователь определен по токену при подключении, кадрам клиента не доверяем
+        self.user_id = user_id
+        self.codec = codec
+        self.rooms: Set[int] = set()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.writer: asyncio.Task = None
+        self.bucket: TokenBucket = None  # лимит кадров подключения
+
+    async def write_loop(self):
+        # Отправляем сообщения из очереди, не блокируя остальных клиентов
+        try:
+            while True:
+                payload = await self.queue.get()
+                if self.codec.binary:
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_text(payload)
+        except Exception:
+            pass
+
+    async def receive(self) -> dict:
+        """Следующий кадр от клиента, раскодированный его кодеком"""
+        message = await self.websocket.receive()
+        if message['type'] == 'websocket.disconnect':
+            raise WebSocketDisconnect(message.get('code', 1000))
+        frame = message.get('bytes') if message.get('text') is None else message['text']
+        return self.codec.decode(frame)
 
 # Хранение активных подключений
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}  # user_id: websocket
+    def __init__(self, broker=None, queue_size: int = 256, slow_client_policy: str = SLOW_CLIENT_DROP,
+                 directory: UserDirectory = None):
+        self.active_connections: Dict[int, Connection] = {}  # user_id: connection
+        self.rooms: Dict[int, Set[Connection]] = {}  # room_id: подключения в комнате
+        # Через шину сообщения доходят до подключений в других процессах
+        self.broker = broker or create_broker()
+        # Справочник пользователей процесса, обновляется событиями 'profile' из шины
+        self.directory = directory if directory is not None else UserDirectory()
+        self.queue_size = queue_size
+        self.slow_client_policy = slow_client_policy
+
+    async def start(self):
+        await self.broker.start(self.deliver)
+
+    async def stop(self):
+        await self.broker.close()
+
+    async def connect(self, websocket: WebSocket, user: dict):
+        # Формат кадров выбираем по подпротоколам, которые предложил клиент
+        codec, subprotocol = negotiate(websocket.scope.get('subprotocols'))
+        await websocket.accept(subprotocol=subprotocol)
+        # Повторное подключение того же пользователя заменяет старое. Старый
+        # сокет закрываем, иначе тот клиент считал бы себя подключенным,
+        # ничего не получал и не переподключался
+        old = self.active_connections.get(user['id'])
+        if old is not None:
+            self.disconnect(user['id'], old)
+            asyncio.create_task(self._close(old, CLOSE_REPLACED))
+        connection = Connection(websocket, user['id'], self.queue_size, codec)
+        connection.writer = asyncio.create_task(connection.write_loop())
+        self.active_connections[user['id']] = connection
+        return connection
 
-    async def connect(self, websocket: WebSocket, user_id: int):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
+    def disconnect(self, user_id: int, connection: Connection = None):
+        """Отключение connection или, без него, текущего подключения пользователя.
 
-    def disconnect(self, user_id: int):
-        if user_id in self.active_connections:
+        Замененное подключение тоже покидает комнаты и останавливает запись,
+        из active_connections удаляется только текущее.
+        """
+        current = self.active_connections.get(user_id)
+        if connection is None:
+            connection = current
+        if connection is None:
+            return
+        if current is connection:
             del self.active_connections[user_id]
+        for room_id in list(connection.rooms):
+            self.leave(connection, room_id)
+        connection.writer.cancel()
+
+    def join(self, connection: Connection, room_id: int):
+        # Замененное подключение, чей обработчик еще читает кадры, в комнаты не возвращаем
+        if self.active_connections.get(connection.user_id) is not connection:
+            return
+        connection.rooms.add(room_id)
+        self.rooms.setdefault(room_id, set()).add(connection)
+
+    def leave(self, connection: Connection, room_id: int):
+        connection.rooms.discard(room_id)
+        members = self.rooms.get(room_id)
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del self.rooms[room_id]
+
+    def send(self, connection: Connection, message: dict):
+        """Сообщение одному подключению в его формате"""
+        self.enqueue(connection, connection.codec.encode(message))
+
+    def enqueue(self, connection: Connection, payload):
+        """Кладет сообщение в очередь клиента, применяя политику для медленных клиентов"""
+        try:
+            connection.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            connection.dropped += 1
+            if self.slow_client_policy == SLOW_CLIENT_DROP:
+                self.disconnect(connection.user_id, connection)
+                asyncio.create_task(self._close(connection))
+
+    async def _close(self, connection: Connection, code: int = 1013):
+        try:
+            await connection.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def broadcast(self, message: dict, room_id: int = None):
+        """Рассылка участникам комнаты или, без room_id, всем подключенным"""
+        target = 'all' if room_id is None else f'room:{room_id}'
+        await self._publish(target, message)
+
+    async def send_to_users(self, message: dict, user_ids):
+        """Адресная доставка: только подключениям перечисленных пользователей"""
+        await self._publish('users:' + ','.join(str(user_id) for user_id in set(user_ids)), message)
+
+    async def publish_profile(self, profile: dict):
+        """Рассылка изменения профиля всем подключенным и справочникам всех процессов"""
+        await self._publish('profiles', {
+            'type': 'profile',
+            'id': profile['id'],
+            'username': profile['username'],
+            'avatar_path': profile['avatar_path'],
+            'bio': profile['bio']
+        })
+
+    async def _publish(self, target: str, message: dict):
+        # Кодируем один раз и публикуем в шину для всех процессов.
+        # Первая строка - получатели, JSON переводов строк не содержит
+        payload = json.dumps(message, ensure_ascii=False)
+        await self.broker.publish(f'{target}\n{payload}')
+
+    def deliver(self, data: str):
+        """Раскладывает сообщение из шины по очередям подключений этого процесса"""
+        target, payload = data.split('\n', 1)
+        # В шине сообщение лежит в обычном JSON; для других форматов
+        # кодируем его один раз на формат, а не на каждое подключение
+        encoded = {'json': payload}
+        message = None
+        if target == 'profiles':
+            message = json.loads(payload)
+            self.directory.update(message['id'], message['username'], message['avatar_path'])
+            recipients = self.active_connections.values()
+        elif target == 'all':
+            recipients = self.active_connections.values()
+        elif target.startswith('users:'):
+            # Личные сообщения ищем по user_id, не перебирая подключения
+            recipients = [
+                self.active_connections[user_id]
+                for user_id in map(int, target[len('users:'):].split(','))
+                if user_id in self.active_connections
+            ]
+        else:
+            # Стоимость доставки зависит от размера комнаты, а не от числа подключенных
+            recipients = self.rooms.get(int(target.split(':', 1)[1]), ())
+        for connection in list(recipients):
+            frame = encoded.get(connection.codec.name)
+            if frame is None:
+                if message is None:
+                    message = json.loads(payload)
+                frame = encoded[connection.codec.name] = connection.codec.encode(message)
+            self.enqueue(connection, frame)
+
+# Имена и аватары авторов сообщений: в БД сообщения хранят только user_id
+directory = UserDirectory()
+manager = ConnectionManager(directory=directory)
+
+# id личных переписок по паре пользователей, чтобы не ходить в БД на каждое сообщение
+conversation_ids: Dict[Tuple[int, int], int] = {}
+
+async def get_conversation_id(user_id: int, other_id: int) -> int:
+    pair = (min(user_id, other_id), max(user_id, other_id))
+    conversation_id = conversation_ids.get(pair)
+    if conversation_id is None:
+        conversation_id = await db.get_or_create_conversation(user_id, other_id)
+        conversation_ids[pair] = conversation_id
+    return conversation_id
+
+async def is_valid_peer(user_id: int, peer_id) -> bool:
+    """Можно ли начать с peer_id личную переписку: это другой существующий пользователь"""
+    # bool - подкласс int, но id пользователя из него не получится
+    if not isinstance(peer_id, int) or isinstance(peer_id, bool) or peer_id == user_id:
+        return False
+    return bool(await user_entries([peer_id]))
+
+async def user_entries(user_ids) -> List[dict]:
+    """Профили авторов для ответа API; недостающих в справочнике дочитывает из БД"""
+    user_ids = set(user_ids)
+    missing = directory.missing(user_ids)
+    if missing:
+        directory.update_many(await db.get_directory(missing))
+    return directory.entries(user_ids)
+
+@app.on_event("startup")
+async def start_manager():
+    # Справочник загружается целиком одним запросом
+    directory.load(await db.get_directory())
+    await manager.start()
+
+@app.on_event("shutdown")
+async def close_database():
+    await manager.stop()
+    await db.flush()
+    db.close()
+
+async def authenticate(token: Optional[str]) -> Optional[dict]:
+    """Пользователь по сессионному токену: {'id', 'username'} или None.
+
+    Подпись проверяется и пользователь читается из БД только при первом
+    предъявлении токена, дальше он берется из кэша сессий.
+    """
+    if not token:
+        return None
+    user = sessions.get(token)
+    if user is None:
+        claims = read_token(token, session_secret)
+        if claims is None:
+            return None
+        user_id, expires_at = claims
+        profile = await db.get_user(user_id)
+        if profile is None:
+            return None
+        user = {'id': profile['id'], 'username': profile['username']}
+        sessions.put(token, user, expires_at)
+    return user
+
+def bearer_token(request: Union[Request, WebSocket]) -> Optional[str]:
+    scheme, _, token = request.headers.get('authorization', '').partition(' ')
+    return token if scheme.lower() == 'bearer' else None
+
+async def prepare_message(connection: Connection, data: dict) -> Optional[dict]:
+    """Проверка кадра с сообщением.
+
+    Возвращает сообщение без id или None, если его не нужно сохранять:
+    ошибка уже отправлена клиенту или это повтор уже сохраненного сообщения.
+    """
+    client_id = data.get('client_id')
+    text = data.get('text')
+    if not isinstance(text, str) or not text.strip() or len(text) > MAX_TEXT_LENGTH:
+        manager.send(connection, {'type': 'error', 'message': 'Недопустимый текст сообщения', 'client_id': client_id})
+        return None
+    if client_id is not None and data.get('retry'):
+        # Повтор из очереди клиента: сообщение могло сохраниться, а подтверждение потеряться
+        saved = await db.find_message_by_client_id(connection.user_id, client_id)
+        if saved is not None:
+            manager.send(connection, saved)
+            return None
+    
+    message = {
+        'user_id': connection.user_id,
+        'text': text,
+        'client_id': client_id
+    }
+    if data.get('type') == 'dm':
+        # Личное сообщение получают только отправитель и адресат
+        peer_id = data.get('to')
+        if not await is_valid_peer(connection.user_id, peer_id):
+            manager.send(connection, {'type': 'error', 'message': 'Получатель не найден', 'client_id': client_id})
+            return None
+        message['conversation_id'] = await get_conversation_id(connection.user_id, peer_id)
+        message['to'] = peer_id
+        return message
+    
+    room_id = data.get('room_id', DEFAULT_ROOM_ID)
+    # Отправка в комнату тоже подписывает на нее
+    if room_id not in connection.rooms:
+        if not await db.room_exists(room_id):
+            manager.send(connection, {'type': 'error', 'message': 'Комната не найдена', 'client_id': client_id})
+            return None
+        manager.join(connection, room_id)
+    message['room_id'] = room_id
+    return message
 
-    async def broadcast(self, message: dict):
-        # Отправляем сообщение всем подключенным пользователям
-        for connection in self.active_connections.values():
-            await connection.send_json(message)
+async def admit(connection: Connection, cost: int) -> bool:
+    """Проверка лимита кадров; при политике delay ждет токенов не дольше max_delay"""
+    wait = limiter.acquire(connection.user_id, connection.bucket, cost)
+    if wait and limiter.config.policy == RATE_LIMIT_DELAY:
+        # Пока обработчик ждет, кадры подключения не читаются и копятся в TCP
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + limiter.config.max_delay
+        while wait and loop.time() + wait <= deadline:
+            await asyncio.sleep(wait)
+            # Токены могли успеть забрать другие подключения пользователя
+            wait = limiter.acquire(connection.user_id, connection.bucket, cost)
+    return not wait
 
-manager = ConnectionManager()
+def reject(connection: Connection, data: dict):
+    """Ошибка на каждое отклоненное сообщение, чтобы клиент пометил его неотправленным"""
+    frames = data.get('messages', ()) if data.get('type') == 'batch' else (data,)
+    client_ids = [frame.get('client_id') for frame in frames if frame.get('client_id') is not None]
+    for client_id in client_ids or (None,):
+        manager.send(connection, {'type': 'error', 'message': 'Слишком много сообщений', 'client_id': client_id})
+
+async def save_message(connection: Connection, message: dict) -> bool:
+    """Сохранение сообщения; при ошибке клиент получает ее для своего client_id"""
+    try:
+        # Ответ приходит после коммита пачки
+        message['id'], message['timestamp'] = await db.save_message(
+            user_id=message['user_id'],
+            text=message['text'],
+            room_id=message.get('room_id', DEFAULT_ROOM_ID),
+            conversation_id=message.get('conversation_id'),
+            client_id=message['client_id']
+        )
+    except sqlite3.Error:
+        manager.send(connection, {
+            'type': 'error', 'message': 'Не удалось сохранить сообщение', 'client_id': message['client_id']
+        })
+        return False
+    return True
+
+async def publish_message(message: dict):
+    if message.get('conversation_id') is not None:
+        await manager.send_to_users(message, [message['user_id'], message['to']])
+    else:
+        await manager.broadcast(message, room_id=message['room_id'])
 
 # API endpoints
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int):
-    await manager.connect(websocket, user_id)
+    # Токен передается в заголовке Authorization; query-параметр остался для
+    # браузерного WebSocket, который не умеет заголовки
+    user = await authenticate(bearer_token(websocket) or websocket.query_params.get('token'))
+    if user is None or user['id'] != user_id:
+        await websocket.close(code=1008)
+        return
+    connection = await manager.connect(websocket, user)
+    connection.bucket = limiter.connection_bucket()
+    manager.join(connection, DEFAULT_ROOM_ID)
     try:
         while True:
-            data = await websocket.receive_json()
-            # Сохраняем сообщение в БД
-            db.save_message(
-                user_id=data['user_id'],
-                username=data['username'],
-                text=data['text']
-            )
-            # Отправляем сообщение всем
-            await manager.broadcast({
-                'user_id': data['user_id'],
-                'username': data['username'],
-                'text': data['text'],
-                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            })
+            data = await connection.receive()
+            frame_type = data.get('type', 'message')
+            room_id = data.get('room_id', DEFAULT_ROOM_ID)
+            
+            # Каждое сообщение пачки - отдельная запись и рассылка, поэтому и токен отдельный
+            cost = max(len(data.get('messages', ())), 1) if frame_type == 'batch' else 1
+            if cost > limiter.config.max_cost:
+                # Такая пачка не пройдет лимиты никогда
+                reject(connection, data)
+                continue
+            if not await admit(connection, cost):
+                if limiter.config.policy == RATE_LIMIT_DISCONNECT:
+                    manager.disconnect(user_id, connection)
+                    await websocket.close(code=1008)
+                    return
+                reject(connection, data)
+                continue
+            
+            if frame_type == 'leave':
+                manager.leave(connection, room_id)
+            elif frame_type == 'join':
+                if room_id not in connection.rooms:
+                    if await db.room_exists(room_id):
+                        manager.join(connection, room_id)
+                    else:
+                        manager.send(connection, {'type': 'error', 'message': 'Комната не найдена'})
+            elif frame_type == 'batch':
+                # Очередь клиента приходит пачкой: проверяем кадры по порядку,
+                # а сохраняем одновременно, чтобы они попали в одну транзакцию
+                messages = []
+                for frame in data['messages']:
+                    message = await prepare_message(connection, frame)
+                    if message is not None:
+                        messages.append(message)
+                saved = await asyncio.gather(*(save_message(connection, message) for message in messages))
+                for message, ok in zip(messages, saved):
+                    if ok:
+                        await publish_message(message)
+            else:
+                message = await prepare_message(connection, data)
+                if message is not None and await save_message(connection, message):
+                    await publish_message(message)
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        pass
+    finally:
+        # Любая ошибка в обработчике тоже убирает подключение из комнат
+        manager.disconnect(user_id, connection)
 
 @app.post("/register")
 async def register(username: str, email: str, password: str):
-    success, error = db.register_user(username, email, password)
+    success, error = await db.register_user(username, email, password)
     if success:
         return {"status": "success"}
     return {"status": "error", "message": error}
 
 @app.post("/login")
 async def login(email: str, password: str):
-    user = db.login_user(email, password)
+    user = await db.login_user(email, password)
     if user:
-        return {"status": "success", "user": user}
+        return {"status": "success", "user": user, "token": issue_token(user['id'], session_secret)}
     return {"status": "error", "message": "Invalid credentials"}
 
+@app.post("/profile")
+async def update_profile(request: Request, username: Optional[str] = None, bio: Optional[str] = None):
+    """Изменение своего профиля; клиенты и справочники получают событие 'profile'"""
+    user = await authenticate(bearer_token(request))
+    if user is None:
+        return Response(status_code=401)
+    success, error = await db.update_profile(user['id'], username, bio)
+    if not success:
+        return {"status": "error", "message": error}
+    profile = await db.get_user_profile(user['id'])
+    # В кэше сессий осталось старое имя
+    sessions.discard_user(user['id'])
+    await manager.publish_profile(profile)
+    return {"status": "success"}
+
+# Наибольший размер загружаемого изображения аватара, байт
+MAX_AVATAR_UPLOAD = 5 * 1024 * 1024
+# Варианты аватара готовятся для экранов с плотностью до 2x
+AVATAR_SCALE = 2.0
+
+@app.post("/avatar")
+async def upload_avatar(request: Request):
+    """Загрузка своего аватара, тело запроса - файл изображения.
+
+    Изображение обрабатывается так же, как на клиенте (process_avatar),
+    клиенты и справочники получают событие 'profile' с новым путем.
+    """
+    user = await authenticate(bearer_token(request))
+    if user is None:
+        return Response(status_code=401)
+    declared = request.headers.get('content-length', '')
+    if declared.isdigit() and int(declared) > MAX_AVATAR_UPLOAD:
+        return Response(status_code=413)
+    
+    fd, upload_path = tempfile.mkstemp(suffix='.upload')
+    try:
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > MAX_AVATAR_UPLOAD:
+                    return Response(status_code=413)
+                f.write(chunk)
+        # Перекодирование занимает десятки мс - не в цикле событий
+        loop = asyncio.get_running_loop()
+        try:
+            avatar_hash, paths = await loop.run_in_executor(
+                None, process_avatar, upload_path, AVATAR_SCALE, AVATARS_DIR
+            )
+        except Exception:
+            return {"status": "error", "message": "Не удалось прочитать изображение"}
+    finally:
+        os.remove(upload_path)
+    
+    if not await db.update_avatar(user['id'], avatar_hash, paths['large']):
+        return {"status": "error", "message": "Не удалось сохранить аватар"}
+    await manager.publish_profile(await db.get_user_profile(user['id']))
+    return {"status": "success", "avatar_path": paths['large']}
+
+# Максимальный размер страницы истории
+MAX_PAGE_SIZE = 100
+
+@app.get("/messages")
+async def get_messages(request: Request, before: Optional[int] = None, limit: int = 50,
+                       room_id: int = DEFAULT_ROOM_ID, conversation_id: Optional[int] = None):
+    """Страница истории комнаты или личной переписки: сообщения старше before,
+    от новых к старым. Личную переписку видят только ее участники,
+    пользователь определяется по токену в заголовке Authorization."""
+    if conversation_id is not None:
+        user = await authenticate(bearer_token(request))
+        if user is None:
+            return Response(status_code=401)
+        if not await db.is_conversation_member(conversation_id, user['id']):
+            return Response(status_code=403)
+    elif room_id == DIRECT_ROOM_ID:
+        # Служебная "комната" всех личных сообщений
+        return {"status": "error", "message": "Комната не найдена"}
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    messages = await db.get_messages(before_id=before, limit=limit, room_id=room_id,
+                                     conversation_id=conversation_id)
+    # Курсор для следующей страницы - id самого старого сообщения
+    next_before = messages[-1]['id'] if len(messages) == limit else None
+    users = await user_entries(message['user_id'] for message in messages)
+    return {"status": "success", "messages": messages, "users": users, "next_before": next_before}
+
+@app.get("/search")
+async def search_messages(q: str, limit: int = 20, before: Optional[int] = None, room_id: Optional[int] = None,
+                          mark_start: str = '[b]', mark_end: str = '[/b]'):
+    """Полнотекстовый поиск по сообщениям комнат, лучшие совпадения первыми.
+    mark_start/mark_end - чем выделять совпадения во фрагменте"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    results = await db.search_messages(q, limit=limit, before_id=before, room_id=room_id,
+                                       highlight=(mark_start, mark_end))
+    users = await user_entries(result['user_id'] for result in results)
+    return {"status": "success", "results": results, "users": users}
+
+# Сколько записей синхронизации читать из БД и отправлять за раз
+SYNC_CHUNK_SIZE = 500
+# Верхняя граница числа сообщений при первой синхронизации
+MAX_INITIAL_SYNC = 5000
+
+@app.get("/sync")
+async def sync(request: Request, since_id: int = 0, profiles_since: int = 0, recent: int = MAX_INITIAL_SYNC):
+    """Все изменения после курсоров клиента потоком NDJSON.
+
+    При первой синхронизации (since_id=0) отправляются только recent
+    последних сообщений: локальная история - это кэш, более старые
+    сообщения клиент запрашивает через /messages.
+
+    Записи идут прямо из курсора SQLite порциями, при Accept-Encoding: gzip
+    поток сжимается. Последняя строка - {"type": "end"} с новыми курсорами:
+    без нее клиент считает поток оборванным и ничего не применяет.
+    Пользователь определяется по токену в заголовке Authorization.
+    """
+    user = await authenticate(bearer_token(request))
+    if user is None:
+        return Response(status_code=401)
+    user_id = user['id']
+    use_gzip = 'gzip' in request.headers.get('accept-encoding', '')
+    recent = max(1, min(recent, MAX_INITIAL_SYNC))
+    
+    async def body():
+        # wbits=31 - формат gzip; SYNC_FLUSH после каждой порции, чтобы
+        # клиент получал данные по мере чтения, а не в конце
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None
+        cursors = {'since_id': since_id, 'profiles_since': profiles_since}
+        
+        def encode(lines):
+            data = ''.join(lines).encode('utf-8')
+            if compressor is None:
+                return data
+            return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        
+        async for chunk in db.iter_changes(user_id, since_id, profiles_since, SYNC_CHUNK_SIZE, recent):
+            lines = []
+            for record in chunk:
+                if record['type'] == 'profile':
+                    cursors['profiles_since'] = record['seq']
+                else:
+                    cursors['since_id'] = record['id']
+                lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+            yield encode(lines)
+        yield encode([json.dumps(dict(cursors, type='end')) + '\n'])
+        if compressor is not None:
+            yield compressor.flush()
+    
+    headers = {'Cache-Control': 'no-store'}
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return StreamingResponse(body(), media_type='application/x-ndjson', headers=headers)
+
+@app.get("/rooms")
+async def get_rooms():
+    return {"status": "success", "rooms": await db.get_rooms()}
+
+@app.post("/rooms")
+async def create_room(request: Request, name: str):
+    """Создание комнаты; только для пользователей с сессией"""
+    if await authenticate(bearer_token(request)) is None:
+        return Response(status_code=401)
+    room_id, error = await db.create_room(name)
+    if room_id is not None:
+        return {"status": "success", "room": {"id": room_id, "name": name}}
+    return {"status": "error", "message": error}
+
+@app.get("/conversations")
+async def get_conversations(request: Request):
+    """Личные переписки пользователя из токена в заголовке Authorization"""
+    user = await authenticate(bearer_token(request))
+    if user is None:
+        return Response(status_code=401)
+    return {"status": "success", "conversations": await db.get_conversations(user['id'])}
+
+@app.post("/conversations")
+async def open_conversation(request: Request, other_id: int):
+    """Личная переписка пользователя из токена с other_id, при необходимости создается"""
+    user = await authenticate(bearer_token(request))
+    if user is None:
+        return Response(status_code=401)
+    if not await is_valid_peer(user['id'], other_id):
+        return {"status": "error", "message": "Пользователь не найден"}
+    return {"status": "success", "conversation_id": await get_conversation_id(user['id'], other_id)}
+
+# Каталог с файлами аватаров и допустимые имена старых аватаров
+AVATARS_DIR = 'avatars'
+LEGACY_AVATAR_NAME = re.compile(r'^user_\d+\.(png|jpg|jpeg)$')
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+def parse_range(header, file_size):
+    """Разбор заголовка Range с одним диапазоном байт.
+
+    Возвращает (start, end) включительно, None - если отдавать весь файл,
+    и False, если диапазон не удовлетворить.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        # Суффикс: последние N байт
+        length = int(end)
+        if length == 0:
+            return False
+        return max(file_size - length, 0), file_size - 1
+    start = int(start)
+    end = min(int(end), file_size - 1) if end else file_size - 1
+    if start >= file_size or start > end:
+        return False
+    return start, end
+
+def iter_file_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(MEDIA_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+@app.get("/media/avatars/{name}")
+async def get_avatar(name: str, request: Request):
+    """Файл аватара с поддержкой ETag, 304 и запросов диапазонов"""
+    hashed = AVATAR_FILE_NAME.match(name)
+    if not hashed and not LEGACY_AVATAR_NAME.match(name):
+        return Response(status_code=404)
+    path = os.path.join(AVATARS_DIR, name)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return Response(status_code=404)
+    
+    if hashed:
+        # Имя содержит хэш содержимого: файл никогда не меняется
+        etag = f'"{os.path.splitext(name)[0]}"'
+        cache_control = 'public, max-age=31536000, immutable'
+    else:
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        cache_control = 'no-cache'
+    headers = {'ETag': etag, 'Cache-Control': cache_control, 'Accept-Ranges': 'bytes'}
+    
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and (if_none_match.strip() == '*'
+                          or etag in [tag.strip() for tag in if_none_match.split(',')]):
+        return Response(status_code=304, headers=headers)
+    
+    range_header = request.headers.get('range')
+    if range_header and request.headers.get('if-range', etag) == etag:
+        byte_range = parse_range(range_header, stat.st_size)
+        if byte_range is False:
+            headers['Content-Range'] = f'bytes */{stat.st_size}'
+            return Response(status_code=416, headers=headers)
+        if byte_range is not None:
+            start, end = byte_range
+            headers['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            headers['Content-Length'] = str(end - start + 1)
+            return StreamingResponse(
+                iter_file_range(path, start, end),
+                status_code=206,
+                headers=headers,
+                media_type=mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            )
+    
+    # Весь файл отдаем через FileResponse: сервер может отправить его
+    # без копирования в Python (sendfile / расширение ASGI pathsend)
+    return FileResponse(path, headers=headers, stat_result=stat)
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Несколько процессов делят подключения между собой и обмениваются
+    # сообщениями через шину на Unix-сокетах
+    workers = int(os.environ.get('CHAT_WORKERS', 1))
+    # Сжатие кадров (permessage-deflate) включается, если клиент его поддерживает
+    options = dict(host="0.0.0.0", port=8000, ws_per_message_deflate=True)
+    if workers > 1:
+        os.environ.setdefault('CHAT_BROKER', 'unix')
+        uvicorn.run("server:app", workers=workers, **options)
+    else:
+        uvicorn.run(app, **options)
\ No newline at end of file
@@ -0,0 +1,22 @@
+import time
+
+class StartupTimer:
+    """Отметки этапов запуска приложения для отчета о холодном старте"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.marks = []
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+
+    def report(self):
+        """Длительность этапов в мс; пишется в лог (на Android - в logcat)"""
+        from kivy.logger import Logger
+        durations = {}
+        previous = self.started
+        for name, moment in self.marks:
+            durations[name] = round((moment - previous) * 1000)
+            previous = moment
+        durations['total'] = round((previous - self.started) * 1000)
+        Logger.info('Startup: ' + ', '.join(f'{name} {ms} мс' for name, ms in durations.items()))
+        return durations
\ No newline at end of file
@@ -0,0 +1,167 @@
+import json
+import random
+import struct
+import threading
+import urllib.parse
+import urllib.request
+import websocket
+from kivy.clock import Clock
+from kivy.logger import Logger
+from protocol import CLOSE_REPLACED, DEFAULT_CODEC, codec_for, subprotocols
+
+def request_session(base_url, email, password, timeout=10):
+    """Вход на сервере: (user_id на сервере, сессионный токен) или None.
+
+    Вызов блокирующий, только для фоновых потоков.
+    """
+    query = urllib.parse.urlencode({'email': email, 'password': password})
+    request = urllib.request.Request(f'{base_url.rstrip("/")}/login?{query}', method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            result = json.load(response)
+    except (OSError, ValueError) as e:
+        Logger.warning(f"Transport: не удалось войти на сервере: {e}")
+        return None
+    if result.get('status') != 'success':
+        return None
+    return result['user']['id'], result['token']
+
+def request_json(base_url, path, params, token, method='GET', timeout=10, data=None):
+    """Запрос к HTTP API сервера от имени сессии: ответ или None при ошибке.
+
+    data - тело запроса (байты). Вызов блокирующий, только для фоновых потоков.
+    """
+    query = urllib.parse.urlencode({key: value for key, value in params.items() if value is not None})
+    request = urllib.request.Request(f'{base_url.rstrip("/")}{path}?{query}', data=data, method=method)
+    request.add_header('Authorization', f'Bearer {token}')
+    if data is not None:
+        request.add_header('Content-Type', 'application/octet-stream')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.load(response)
+    except (OSError, ValueError) as e:
+        Logger.warning(f"Transport: ошибка запроса {path}: {e}")
+        return None
+
+def send_profile(base_url, token, username, bio, timeout=10):
+    """Изменение профиля на сервере: (успех, ошибка). Вызов блокирующий"""
+    result = request_json(base_url, '/profile', {'username': username, 'bio': bio}, token,
+                          method='POST', timeout=timeout)
+    if result is None:
+        return False, None
+    return result.get('status') == 'success', result.get('message')
+
+def upload_avatar(base_url, token, file_path, timeout=30):
+    """Загрузка изображения аватара на сервер: (успех, ошибка). Вызов блокирующий"""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    result = request_json(base_url, '/avatar', {}, token, method='POST', timeout=timeout, data=data)
+    if result is None:
+        return False, None
+    return result.get('status') == 'success', result.get('message')
+
+class ChatTransport:
+    """Постоянное WebSocket-подключение к серверу.
+
+    Работает в фоновом потоке, при обрыве переподключается с
+    экспоненциальной задержкой. Входящие сообщения передаются в
+    интерфейс через Clock.schedule_once, то есть в главном потоке.
+    Формат кадров согласуется с сервером при подключении: codecs -
+    предпочитаемые форматы (по умолчанию компактные, если доступны).
+    Токен сессии передается в заголовке Authorization, а не в адресе,
+    чтобы не попадать в журналы запросов.
+    """
+    def __init__(self, url, on_message, on_connect=None, min_delay=1, max_delay=30, codecs=None, token=None):
+        self.url = url
+        self.header = [f'Authorization: Bearer {token}'] if token else []
+        self.subprotocols = subprotocols(codecs)
+        self.codec = DEFAULT_CODEC
+        self.on_message = on_message
+        self.on_connect = on_connect
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._ws = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def connected(self):
+        return self._ws is not None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='chat-transport', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def send(self, data):
+        """Отправка сообщения, возвращает False, если соединения нет"""
+        ws = self._ws
+        if ws is None:
+            return False
+        try:
+            codec = self.codec
+            if codec.binary:
+                ws.send_binary(codec.encode(data))
+            else:
+                ws.send(codec.encode(data))
+            return True
+        except Exception as e:
+            Logger.warning(f"Transport: ошибка отправки: {e}")
+            return False
+
+    def _run(self):
+        delay = self.min_delay
+        while not self._stopped.is_set():
+            ws = None
+            try:
+                ws = websocket.create_connection(self.url, timeout=10, header=self.header,
+                                             subprotocols=self.subprotocols)
+                # Таймаут нужен только на подключение, дальше ждем сообщений сколько угодно
+                ws.settimeout(None)
+                # Старый сервер подпротокол не выберет - тогда остается обычный JSON
+                self.codec = codec_for(ws.getsubprotocol())
+                self._ws = ws
+                delay = self.min_delay
+                Logger.info(f"Transport: подключено к {self.url}")
+                if self.on_connect:
+                    Clock.schedule_once(lambda dt: self.on_connect())
+                
+                while not self._stopped.is_set():
+                    opcode, frame = ws.recv_data()
+                    if opcode == websocket.ABNF.OPCODE_CLOSE:
+                        if frame[:2] == struct.pack('!H', CLOSE_REPLACED):
+                            # Пользователь подключился с другого устройства: не
+                            # отбираем подключение обратно, иначе они будут сменять друг друга
+                            Logger.info("Transport: подключение заменено новым, переподключение остановлено")
+                            self._stopped.set()
+                        break
+                    if opcode == websocket.ABNF.OPCODE_TEXT:
+                        frame = frame.decode('utf-8')
+                    elif opcode != websocket.ABNF.OPCODE_BINARY or not frame:
+                        continue
+                    message = self.codec.decode(frame)
+                    Clock.schedule_once(lambda dt, m=message: self.on_message(m))
+            except Exception as e:
+                if not self._stopped.is_set():
+                    Logger.warning(f"Transport: соединение потеряно: {e}")
+            finally:
+                self._ws = None
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+            
+            # Экспоненциальная задержка со случайной составляющей,
+            # чтобы клиенты не переподключались одновременно
+            self._stopped.wait(delay * random.uniform(0.5, 1))
+            delay = min(delay * 2, self.max_delay)
\ No newline at end of file
@@ -1,9 +1,34 @@
-from PIL import Image, ImageDraw
+import hashlib
+import json
 import os
+import re
+from dataclasses import fields
+
+# Размеры вариантов аватара в dp: маленький для списка сообщений, большой для профиля
+AVATAR_SIZES = {'small': 40, 'large': 150}
+# Имя файла варианта: <хэш содержимого>_<размер>.<расширение>
+AVATAR_FILE_NAME = re.compile(r'^([0-9a-f]{16})_\d+(\.\w+)$')
+DEFAULT_AVATAR_PATH = 'assets/default_avatar.png'
+
+# Pillow импортируется внутри функций: модуль нужен и там, где работа
+# с изображениями не требуется (сервер, запуск клиента)
+
+def load_settings(config_class, section, settings_path='settings.json'):
+    """Настройки-dataclass со значениями из секции файла настроек, если она есть"""
+    config = config_class()
+    try:
+        with open(settings_path, encoding='utf-8') as f:
+            values = json.load(f).get(section, {})
+    except (OSError, ValueError):
+        return config
+    for field in fields(config_class):
+        if field.name in values:
+            setattr(config, field.name, values[field.name])
+    return config
 
 def create_default_avatar():
     """Создает аватар по умолчанию, если он не существует"""
-    avatar_path = 'assets/default_avatar.png'
+    avatar_path = DEFAULT_AVATAR_PATH
     
     # Создаем папку assets, если её нет
     if not os.path.exists('assets'):
@@ -11,6 +36,8 @@ def create_default_avatar():
     
     # Создаем аватар, только если его нет
     if not os.path.exists(avatar_path):
+        from PIL import Image, ImageDraw
+        
         # Создаем новое изображение
         size = (200, 200)
         img = Image.new('RGB', size, color='#2196F3')  # Material Blue color
@@ -26,4 +53,57 @@ def create_default_avatar():
         # Сохраняем изображение
         img.save(avatar_path)
     
-    return avatar_path
\ No newline at end of file
+    return avatar_path
+
+def process_avatar(source_path, scale=1.0, directory='avatars'):
+    """Подготовка загруженного аватара.
+
+    Поворачивает изображение по EXIF и отбрасывает метаданные, обрезает
+    до квадрата и сохраняет компактные варианты всех размеров из
+    AVATAR_SIZES (в пикселях - размер в dp, умноженный на scale).
+    В имени файла - хэш исходного содержимого. Возвращает пару
+    (хэш, {вариант: путь}). Выполняется долго, вызывать вне UI-потока.
+    """
+    from PIL import Image, ImageOps, features
+    
+    with open(source_path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    
+    # WebP заметно меньше JPEG, но может быть не собран в Pillow
+    extension = 'webp' if features.check('webp') else 'jpg'
+    
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    
+    paths = {}
+    for name, size in AVATAR_SIZES.items():
+        path = os.path.join(directory, f'{digest}_{size}.{extension}')
+        try:
+            # Файл используется повторно: свежее время изменения не даст
+            # сборке мусора удалить его до назначения аватара
+            os.utime(path)
+        except FileNotFoundError:
+            pixels = max(1, round(size * scale))
+            variant = ImageOps.fit(image, (pixels, pixels), Image.LANCZOS)
+            # EXIF не передаем, поэтому в файл он не попадает
+            if extension == 'webp':
+                variant.save(path, 'WEBP', quality=80, method=4)
+            else:
+                variant.save(path, 'JPEG', quality=85, optimize=True, progressive=True)
+        paths[name] = path
+    return digest, paths
+
+def avatar_variant(path, name):
+    """Путь к варианту аватара нужного размера.
+
+    Для файлов, созданных process_avatar, подставляет размер в имя,
+    остальные пути (старые аватары, аватар по умолчанию) возвращает как есть.
+    """
+    match = AVATAR_FILE_NAME.match(os.path.basename(path or ''))
+    if not match:
+        return path
+    file_name = f'{match.group(1)}_{AVATAR_SIZES[name]}{match.group(2)}'
+    return os.path.join(os.path.dirname(path), file_name)
\ No newline at end of file